@@ -1,13 +1,89 @@
+import argparse
 import asyncio
+import os
 import sys
 
-import telepot
-from telepot.aio.delegate import pave_event_space, per_chat_id, create_open, include_callback_query_chat_id
-from telepot.aio.loop import MessageLoop
-
-from handler import DudoHandler
+from hibernation import HIBERNATION_DIR
+from journal import JOURNAL_FILE
+from stats import STATS_FILE
 
 TOKEN = ""
+LISTEN = "0.0.0.0:8443"
+
+# Only what every mode needs is imported up front: webhooks, sharding
+# and metrics are imported by the modes that use them, and worker
+# processes, which import this module again, pay for none of them.
+
+
+def start_webhook(handle, options):
+    """ Starts taking updates from Telegram's POSTs and registers the webhook. """
+    import telepot.aio
+    from webhook import WebhookServer, new_secret, register
+
+    secret = options.secret or new_secret()
+    host, _, port = options.listen.rpartition(":")
+    server = WebhookServer(handle, secret)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.start(host, int(port)))
+    loop.run_until_complete(register(telepot.aio.Bot(TOKEN), options.webhook, secret))
+    return server
+
+
+def warm_up():
+    """ Builds what every game shares: insult grammars and pools, and translations. """
+    from catalogs import load_catalogs
+    from insults import get_insulter
+
+    get_insulter().fill_pools()
+    load_catalogs()
+
+
+def prepare(options, bot_class=None):
+    """ Builds the bot of a single process, recovering the journal's
+        games. Unless lazy, everything games share is built first.
+    """
+    from handler import make_bot
+    from hibernation import Hibernator
+    from journal import Journal
+    from outbox import Outbox
+    from stats import Stats
+
+    if not options.lazy:
+        warm_up()
+
+    outbox = Outbox()
+    journal = Journal(options.journal) if options.journal else None
+    hibernator = Hibernator(options.hibernate_after, options.hibernate_dir) if options.hibernate_after else None
+    stats = Stats(options.stats) if options.stats else None
+
+    bot = make_bot(TOKEN, outbox, journal, options.edit_in_place, bot_class, hibernator, stats)
+    return bot, journal, stats
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog="dudo-bot")
+    parser.add_argument("--edit-in-place", action="store_true",
+                        help="edit the last turn announcement instead of sending a new one")
+    parser.add_argument("--journal", default=JOURNAL_FILE, metavar="PATH",
+                        help="game journal used to recover games after a restart (empty to disable)")
+    parser.add_argument("--stats", default=STATS_FILE, metavar="PATH",
+                        help="where player statistics are kept, shared by every worker (empty to disable)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes to shard chats across, each with its own journal")
+    parser.add_argument("--webhook", metavar="URL",
+                        help="public URL to receive updates on, instead of long polling")
+    parser.add_argument("--listen", default=LISTEN, metavar="HOST:PORT", help="where the webhook server listens")
+    parser.add_argument("--secret", default=os.environ.get("DUDO_WEBHOOK_SECRET"),
+                        help="webhook secret token (default: $DUDO_WEBHOOK_SECRET, or a random one)")
+    parser.add_argument("--hibernate-after", type=float, metavar="SECONDS",
+                        help="put games waiting for players or a question to sleep on disk after this long idle")
+    parser.add_argument("--hibernate-dir", default=HIBERNATION_DIR, metavar="PATH",
+                        help="where sleeping games are kept")
+    parser.add_argument("--metrics", metavar="HOST:PORT",
+                        help="serve Prometheus metrics there (with --workers, worker N serves them on PORT+N)")
+    parser.add_argument("--lazy", action="store_true",
+                        help="start taking updates at once, building grammars and translations on first use")
+    return parser.parse_args(args)
 
 
 def main(args=None):
@@ -15,14 +91,46 @@ def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
-    bot = telepot.aio.DelegatorBot(TOKEN, [
-        include_callback_query_chat_id(pave_event_space())(
-            per_chat_id(types=["group"]), create_open, DudoHandler, timeout=300),
-    ])
+    options = parse_args(args)
+
+    from logconfig import setup_logging
+    setup_logging()
+
+    if options.workers > 1:
+        import telepot.aio
+        import sharding
+
+        options.token = TOKEN
+        options.stand_in = None
+        if options.webhook:
+            front = sharding.Front(options)
+            front.start()
+            start_webhook(front.dispatch, options)
+            # Until every worker died
+            asyncio.get_event_loop().run_until_complete(front.failed)
+        else:
+            sharding.serve(options, sharding.telegram_updates(telepot.aio.Bot(TOKEN)))
+        return
+
+    bot, journal, stats = prepare(options)
 
     loop = asyncio.get_event_loop()
-    loop.create_task(MessageLoop(bot).run_forever())
-    loop.run_forever()
+    if options.metrics:
+        from metrics import start_metrics
+        start_metrics(options.metrics)
+    if options.webhook:
+        from webhook import bot_handler
+        start_webhook(bot_handler(bot), options)
+    else:
+        from telepot.aio.loop import MessageLoop
+        loop.create_task(MessageLoop(bot).run_forever())
+    try:
+        loop.run_forever()
+    finally:
+        if journal is not None:
+            journal.close()
+        if stats is not None:
+            stats.close()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,10 @@
 class PlayerAction:
+    # One is allocated per incoming message, so none of them has a __dict__
+    __slots__ = ("action", "player")
+
+    # Constructor arguments, in order, used to journal the action
+    fields = ("player",)
+
     def __init__(self, action, player=None):
         self.player = player
         self.action = action
@@ -14,8 +20,14 @@ class PlayerAction:
     def apply(self, context, state):
         raise NotImplementedError("not implemented")
 
+    def to_record(self):
+        return [self.action] + [getattr(self, field) for field in self.fields]
+
 
 class Join(PlayerAction):
+    __slots__ = ("name",)
+    fields = ("player", "name")
+
     def __init__(self, player, name):
         PlayerAction.__init__(self, "Join", player)
         self.name = name
@@ -25,6 +37,8 @@ class Join(PlayerAction):
 
 
 class Flee(PlayerAction):
+    __slots__ = ()
+
     def __init__(self, player):
         PlayerAction.__init__(self, "Flee", player)
 
@@ -33,6 +47,9 @@ class Flee(PlayerAction):
 
 
 class MakeQuestion(PlayerAction):
+    __slots__ = ("question", "initial_bet")
+    fields = ("player", "question", "initial_bet")
+
     def __init__(self, player, question, initial_bet):
         PlayerAction.__init__(self, "MakeQuestion", player)
         self.question = question
@@ -43,6 +60,9 @@ class MakeQuestion(PlayerAction):
 
 
 class Answer(PlayerAction):
+    __slots__ = ("answer",)
+    fields = ("player", "answer")
+
     def __init__(self, player, answer):
         PlayerAction.__init__(self, "Answer", player)
         self.answer = answer
@@ -52,6 +72,9 @@ class Answer(PlayerAction):
 
 
 class MakeBet(PlayerAction):
+    __slots__ = ("bet",)
+    fields = ("player", "bet")
+
     def __init__(self, player, bet):
         PlayerAction.__init__(self, "MakeBet", player)
         self.bet = bet
@@ -61,6 +84,8 @@ class MakeBet(PlayerAction):
 
 
 class Doubt(PlayerAction):
+    __slots__ = ()
+
     def __init__(self, player):
         PlayerAction.__init__(self, "Doubt", player)
 
@@ -69,6 +94,8 @@ class Doubt(PlayerAction):
 
 
 class Fit(PlayerAction):
+    __slots__ = ()
+
     def __init__(self, player):
         PlayerAction.__init__(self, "Fit", player)
 
@@ -76,9 +103,29 @@ class Fit(PlayerAction):
         state.on_fit(context, self.player)
 
 
+class AddAI(PlayerAction):
+    __slots__ = ()
+
+    def __init__(self, player):
+        PlayerAction.__init__(self, "AddAI", player)
+
+    def apply(self, context, state):
+        state.on_add_ai(context, self.player)
+
+
 class End(PlayerAction):
+    __slots__ = ()
+
     def __init__(self, player):
         PlayerAction.__init__(self, "End", player)
 
     def apply(self, context, state):
         state.on_destroy(context, self.player)
+
+
+ACTIONS = dict((action.__name__, action)
+               for action in (Join, Flee, MakeQuestion, Answer, MakeBet, Doubt, Fit, AddAI, End))
+
+
+def action_from_record(record):
+    return ACTIONS[record[0]](*record[1:])
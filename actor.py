@@ -0,0 +1,72 @@
+import asyncio
+from time import perf_counter
+
+from metrics import METRICS
+
+
+class GameActor:
+    """ Owns a game's state machine. Handlers and timers only post to
+        its mailbox; a single task, alive only while there is mail,
+        applies everything pending in order and then flushes the game's
+        announcements once for the whole batch. A burst of votes costs
+        one flush, and nothing else ever touches the game, so it needs
+        no lock.
+    """
+    __slots__ = ("context", "mailbox", "task")
+
+    # Process-wide counts, for reports
+    inputs = 0
+    batches = 0
+
+    def __init__(self, context):
+        self.context = context
+        self.mailbox = []
+        self.task = None
+
+    def post(self, function, *args):
+        """ Has the actor call function(*args) after everything posted before. """
+        # Waits are only timed while metrics are being scraped
+        self.mailbox.append((function, args, perf_counter() if METRICS.enabled else None))
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        try:
+            while self.mailbox:
+                batch, self.mailbox = self.mailbox, []
+                GameActor.inputs += len(batch)
+                GameActor.batches += 1
+
+                for function, args, posted in batch:
+                    measured = METRICS.enabled
+                    if measured:
+                        start = perf_counter()
+                        if posted is not None:
+                            METRICS.mailbox_wait_seconds.observe(start - posted)
+                    try:
+                        function(*args)
+                    except Exception:
+                        self.context.logger.exception("Could not apply %s", getattr(function, "__name__", function))
+                    if measured:
+                        METRICS.apply_seconds[getattr(function, "__name__", "other")].observe(perf_counter() - start)
+
+                measured = METRICS.enabled
+                if measured:
+                    start = perf_counter()
+                try:
+                    await self.context.force_announce()
+                except Exception:
+                    self.context.logger.exception("Could not announce")
+                if measured:
+                    METRICS.announce_seconds.observe(perf_counter() - start)
+        finally:
+            self.task = None
+
+    async def drained(self):
+        """ Waits until everything posted so far is applied and announced. """
+        while self.task is not None:
+            await asyncio.shield(self.task)
+
+    @classmethod
+    def stats(cls):
+        return {"inputs": cls.inputs, "batches": cls.batches}
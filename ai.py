@@ -0,0 +1,58 @@
+""" Players the bot plays itself, added with /addbot to games short of
+    people. They answer polls and guess, but never ask: they would have
+    nothing to ask about, so they are left out of the questioners.
+
+    They are told apart by their ids, which are negative; Telegram's
+    user ids never are. Their moves are posted to the game as any
+    other input, so they are journaled and replayed like the rest.
+"""
+import random
+
+from actions import Doubt, Fit, MakeBet
+from probability import ENGINE
+
+MAX_AI_PLAYERS = 4
+AI_NAME = "Robot %d"
+# Seconds an AI player takes to move, so that the chat can follow
+AI_DELAY = 1.5
+# How often each AI player answers yes, by number
+AI_RATES = (0.5, 0.3, 0.7, 0.4)
+
+_rng = random.Random()
+
+
+def is_ai(player):
+    return player is not None and player < 0
+
+
+def new_ai_player(players):
+    """ The first AI player not in players, or None if all are. """
+    for number in range(1, MAX_AI_PLAYERS + 1):
+        if -number not in players:
+            return -number
+    return None
+
+
+def ai_name(player):
+    return AI_NAME % -player
+
+
+def vote(player):
+    return 1 if _rng.random() < AI_RATES[(-player - 1) % len(AI_RATES)] else 0
+
+
+def guess(player, answer, players, bet, engine=ENGINE):
+    """ Whichever of raising by one, doubting or fitting is likeliest
+        to win, knowing its own answer and the others' yes rates.
+    """
+    odds = engine.odds([other for other in players if other != player], (answer,))
+    doubt, fit = odds.doubt(bet), odds.fit(bet)
+    # Raising any higher only makes it less likely to stand
+    target = bet + 1
+    raising = odds.stands(target) if target <= odds.players else -1.0
+
+    if raising >= doubt and raising >= fit:
+        return MakeBet(player, target)
+    if doubt >= fit:
+        return Doubt(player)
+    return Fit(player)
@@ -1,47 +1,81 @@
-import gettext
+import asyncio
 import logging
-import sys
+import os
 from collections import OrderedDict
 
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 
-from insults import Insulter
+from catalogs import DEFAULT_LOCALE, get_catalog
+from insults import get_insulter
+from logconfig import GameLogger
+
+POLL_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text='Yes', callback_data='yes'),
+     InlineKeyboardButton(text='No', callback_data='no')],
+])
 
 
 class Announcer:
-    def __init__(self, sender):
-        self.angery_level = 0
-        self.logger = logging.getLogger("dudo.announcer")
-        self.logger.setLevel(logging.DEBUG)
-        ch = logging.StreamHandler(sys.stdout)
-        ch.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        ch.setFormatter(formatter)
-        self.logger.addHandler(ch)
+    # Idle games are kept around for as long as their chat lives, so
+    # they are slotted and everything they share is on the class
+    __slots__ = ("angery_level", "chat_id", "game_id", "current_poll", "poll_index", "mode", "locale",
+                 "catalog", "insulter", "insult_rng", "announcement_buffer", "sender", "edit_in_place",
+                 "status", "status_message", "messages_sent")
+
+    base_logger = logging.getLogger("dudo.announcer")
+
+    modes_thresholds = OrderedDict([
+        ("soft", 1.0),
+        ("normal", 2.0),
+        ("chilean", 3.0),
+        ("trava", float("infinity")),
+    ])
+
+    # Angrier modes switch to their own locale, whatever the chat picked
+    modes_locales = {"chilean": "chilean", "trava": "chilean"}
 
-        self.modes_thresholds = OrderedDict()
+    def __init__(self, sender, chat_id=None):
+        self.angery_level = 0
+        self.chat_id = chat_id
+        # uuid would do, but importing it alone slows startup down noticeably
+        self.game_id = os.urandom(4).hex()
 
         self.current_poll = None
         self.poll_index = 0
 
-        self.modes_thresholds["soft"] = 1.0
-        self.modes_thresholds["normal"] = 2.0
-        self.modes_thresholds["chilean"] = 3.0
-        self.modes_thresholds["trava"] = float("infinity")
-
         self.mode = "soft"
+        self.locale = DEFAULT_LOCALE
 
-        self.insulter = Insulter("insults.json")
-        self.insulter.load()
+        self.insulter = get_insulter()
+        # Seeded generator for reproducible insults, pooled ones otherwise
+        self.insult_rng = None
 
-        # self.locale (?)
         self.announcement_buffer = []
         self.sender = sender
 
-        self.english = gettext.translation('dudobot', localedir="translations", languages=["en"], fallback=True)
-        self.spanish = gettext.translation('dudobot', localedir="translations", languages=["chilean"], fallback=True)
+        # With edit_in_place, turn and bet announcements edit our last
+        # message instead of sending a new one, while it's still the last
+        self.edit_in_place = False
+        self.status = None
+        self.status_message = None
+        self.messages_sent = 0
+
+        self.catalog = get_catalog(self.locale)
+
+    @property
+    def logger(self):
+        # Built on demand, to keep an adapter per game out of memory
+        return GameLogger(self.base_logger, self)
+
+    def _(self, message):
+        return self.catalog.gettext(message)
 
-        self._ = self.english.gettext
+    def set_locale(self, locale):
+        self.locale = locale
+        self.update_translation()
+
+    def update_translation(self):
+        self.catalog = get_catalog(self.modes_locales.get(self.mode, self.locale))
 
     def update_mode(self):
         angery_level = self.angery_level
@@ -52,42 +86,74 @@ class Announcer:
                 if self.mode == mode:
                     return
                 self.mode = mode
-                if mode == "normal" or mode == "soft":
-                    self._ = self.english.gettext
-                else:
-                    self._ = self.spanish.gettext
+                self.update_translation()
                 return
 
     def announce(self, announcement):
         self.announcement_buffer.append(announcement)
 
+    def announce_status(self, announcement):
+        if self.edit_in_place:
+            self.status = announcement
+        else:
+            self.announce(announcement)
+
     async def force_announce(self):
+        lines = self.announcement_buffer
+        self.announcement_buffer = []
+        status = self.status
+        self.status = None
+
         if self.current_poll is not None:
 
             player, question, initial_bet = self.current_poll
             self.current_poll = None
 
-            if len(self.announcement_buffer[:self.poll_index]) > 0:
-                await self.sender.sendMessage("\n".join(self.announcement_buffer[:self.poll_index]))
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text='Yes', callback_data='yes'),
-                 InlineKeyboardButton(text='No', callback_data='no')],
-            ])
-
-            await self.sender.sendMessage(
-                self._("%s asks '%s', starting with %d %s.") %
-                (player, question, initial_bet, self._("person") if initial_bet == 1 else self._("people")),
-                reply_markup=keyboard)
-
-            if len(self.announcement_buffer[self.poll_index:]) > 0:
-                await self.sender.sendMessage("\n".join(self.announcement_buffer[self.poll_index:]))
-            self.announcement_buffer = []
-
-        elif len(self.announcement_buffer) > 0:
-            announcement = "\n".join(self.announcement_buffer)
-            self.logger.debug("Announcing '%s'" % " ".join(self.announcement_buffer))
-            self.announcement_buffer = []
-            await self.sender.sendMessage(announcement)
+            lines.insert(self.poll_index,
+                         self._("%s asks '%s', starting with %d %s.") %
+                         (player, question, initial_bet, self._("person") if initial_bet == 1 else self._("people")))
+            if status is not None:
+                lines.append(status)
+
+            # Editing the poll would drop its keyboard, so it can't hold the status
+            await self.send("\n".join(lines), reply_markup=POLL_KEYBOARD)
+
+        elif len(lines) > 0:
+            self.logger.debug("Announcing '%s'", " ".join(lines))
+            if status is None:
+                await self.send("\n".join(lines))
+            else:
+                prefix = "\n".join(lines)
+                self.remember_status_message(await self.send(prefix + "\n" + status), prefix, status)
+
+        elif status is not None:
+            if self.status_message is None:
+                self.remember_status_message(await self.send(status), None, status)
+            else:
+                message_id, prefix, current_status = self.status_message
+                if status != current_status:
+                    self.status_message = (message_id, prefix, status)
+                    await self.sender.editMessageText(message_id, status if prefix is None else prefix + "\n" + status)
+
+    async def send(self, text, **kwargs):
+        self.messages_sent += 1
+        self.status_message = None
+        return await self.sender.sendMessage(text, **kwargs)
+
+    def remember_status_message(self, sent, prefix, status):
+        """ Keeps the id of the message that holds the status once it
+            is known, unless something else was sent in the meantime.
+        """
+        messages_sent = self.messages_sent
+
+        def remember(message):
+            if messages_sent == self.messages_sent and message is not None:
+                self.status_message = (message["message_id"], prefix, status)
+
+        if isinstance(sent, asyncio.Future):
+            sent.add_done_callback(lambda f: f.cancelled() or f.exception() or remember(f.result()))
+        else:
+            remember(sent)
 
     def get_angery(self):
         self.logger.debug("Getting angery...")
@@ -113,12 +179,12 @@ class Announcer:
 
     def announce_too_high_bet(self, n_players):
         self.announce(self._("%s You can't bet that high. There's only %d players!")
-                      % (self.insulter.get_insult(self.mode), n_players))
+                      % (self.insulter.get_insult(self.mode, self.insult_rng), n_players))
         self.get_angery()
 
     def announce_too_low_bet(self, current_bet):
         self.announce(self._("%s You should bet at least %d. If you can't, maybe you should doubt or fit.")
-                      % (self.insulter.get_insult(self.mode), current_bet))
+                      % (self.insulter.get_insult(self.mode, self.insult_rng), current_bet))
         self.get_angery()
 
     def announce_invalid_question(self):
@@ -140,7 +206,7 @@ class Announcer:
         self.announce(self._("Current players are: %s.") % names)
 
     def announce_questioner(self, name):
-        self.announce(self._("%s, it's your turn to ask a question.") % name)
+        self.announce_status(self._("%s, it's your turn to ask a question.") % name)
 
     def announce_join(self, name):
         self.announce(self._("%s joined!") % name)
@@ -149,8 +215,8 @@ class Announcer:
         self.announce(self._("%s fled!") % name)
 
     def announce_guesser(self, name, question, bet):
-        self.announce(self._("%s, it's your turn to make a guess. Question is '%s'. Current bet is %d.")
-                      % (name, question, bet))
+        self.announce_status(self._("%s, it's your turn to make a guess. Question is '%s'. Current bet is %d.")
+                             % (name, question, bet))
 
     def announce_round_finished(self, winner, loser, voters):
         self.announce(
@@ -159,3 +225,15 @@ class Announcer:
     def announce_end_game_too_few_players(self):
         self.announce(self._("Ending game, not enough players :("))
 
+    def announce_too_many_ai_players(self):
+        self.announce(self._("There's no room for more robots."))
+
+    def announce_no_hint(self):
+        self.announce(self._("Hints are only given when someone has to guess."))
+
+    def announce_hint(self, bet, doubt, fit, stands):
+        self.announce(self._("At %d, doubting wins %.0f%% of the time and fitting %.0f%%.") %
+                      (bet, doubt * 100, fit * 100))
+        if stands:
+            self.announce(self._("Chances of a raise standing: %s.") %
+                          ", ".join("%d: %.0f%%" % (n, chance * 100) for n, chance in stands))
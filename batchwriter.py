@@ -0,0 +1,80 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BatchWriter:
+    """ Write-behind to SQLite (WAL mode). Writes only go into an
+        in-memory batch; at most flush_interval seconds after the first
+        of them, a single writer thread commits the whole batch in one
+        transaction. Reads go through the same thread, so they see
+        whatever was flushed before them.
+
+        Subclasses say what a batch is, with new_batch(), and how it's
+        written, with write_batch(batch).
+    """
+
+    # What batches hold, for the log
+    contents = "entries"
+
+    def __init__(self, path, schema, flush_interval, logger, timeout=5.0):
+        self.logger = logger
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self.pending = self.new_batch()
+        self.flush_handle = None
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.connection = None
+        self.executor.submit(self._open, schema, timeout).result()
+
+    def _open(self, schema, timeout):
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(schema)
+        self.connection.commit()
+
+    def new_batch(self):
+        raise NotImplementedError("not implemented")
+
+    def write_batch(self, batch):
+        raise NotImplementedError("not implemented")
+
+    def schedule_flush(self):
+        """ Has the pending batch flushed in a while, if it isn't already. """
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """ Hands the pending batch to the writer thread. Returns a
+            future that is done once it's committed.
+        """
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        batch = self.pending
+        self.pending = self.new_batch()
+        return self.executor.submit(self._write, batch)
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            with self.connection:
+                self.write_batch(batch)
+        except sqlite3.Error:
+            self.logger.exception("Could not write %d %s", len(batch), self.contents)
+
+    def read(self, function, *args):
+        """ Runs function(*args) on the writer thread, after everything
+            flushed so far. Returns its concurrent future.
+        """
+        return self.executor.submit(function, *args)
+
+    def close(self):
+        self.flush().result()
+        self.executor.submit(self.connection.close).result()
+        self.executor.shutdown()
@@ -0,0 +1,173 @@
+""" Fuzzing and parse throughput of the command router, against the
+    if/elif chain DudoHandler used before commands.py.
+
+    The fuzzer checks that the router never raises, and that it routes
+    every message the way the old chain did. Messages are compared when
+    the command is followed by a single space, since the old parsers
+    split on that space but picked the command on any whitespace.
+
+    Usage: python bench_commands.py [--fuzz N] [--bench N] [--seed N]
+"""
+import argparse
+import random
+import sys
+import time
+
+from commands import BOT_NAME, COMMANDS, ROUTER
+
+LEGACY_NO_GAME = ("/startgame", "/help", "/language")
+LEGACY_IN_GAME = ("/join", "/flee", "/ask", "/raise", "/dudo", "/calzo", "/language", "/endgame")
+
+COMMAND_TOKENS = ["/startgame", "/help", "/language", "/lang", "/endgame", "/join", "/flee", "/ask", "/raise",
+                  "/bet", "/dudo", "/doubt", "/calzo", "/calza", "/fit", "/JOIN", "/Raise", "/", "/foo", "join"]
+SUFFIXES = ["", "", "", BOT_NAME, BOT_NAME.upper(), "@otherbot", "@", BOT_NAME + BOT_NAME]
+PIECES = ["##", "#", "3", "12", "-1", "0", "1_0", "٣", "x", "es", "en", "chilean", "is it red?",
+          "?", "ñandú", " ", "  ", "\t", "\n", " ", "@du2bot", "/join"]
+ALIASES = dict((alias, command.name) for command in COMMANDS for alias in command.aliases)
+CHATTER = ["hola", "jajaja", "who's in?", "ok", "lol /join later", "brb", "¿quién pregunta?", "👍"]
+
+
+def legacy_parse_question(text):
+    if len(text.split(" ", 1)) <= 1:
+        return None, None
+
+    text = text.split(" ", 1)[1]
+
+    tokens = text.split("##", 1)
+
+    if len(tokens) < 2:
+        return None, None
+
+    try:
+        question = tokens[0]
+        initial_bet = int(tokens[1])
+
+        return question, initial_bet
+
+    except ValueError:
+        return None, None
+
+
+def legacy_parse_bet(text):
+    try:
+        text = text.split(" ", 1)[1]
+        return int(text)
+    except ValueError:
+        return None
+    except IndexError:
+        return None
+
+
+def legacy_route(text, in_game):
+    """ The old on_chat_message and handle_command dispatch, returning
+        (command, arguments) as the router does, or None.
+    """
+    tokens = text.split()
+
+    if len(tokens) == 0:
+        return None
+
+    command = tokens[0].lower()
+    if command.endswith(BOT_NAME):
+        command = command[:-len(BOT_NAME)]
+
+    if command not in (LEGACY_IN_GAME if in_game else LEGACY_NO_GAME):
+        return None
+
+    if command == "/ask":
+        return command, legacy_parse_question(text)
+    elif command == "/raise":
+        bet = legacy_parse_bet(text)
+        return command, None if bet is None else (bet,)
+    elif command == "/language":
+        return command, (tokens[1] if len(tokens) >= 2 else None,)
+    return command, ()
+
+
+def unalias(message):
+    """ The same message with the canonical command name, which is all
+        the old chain understood.
+    """
+    token, space, rest = message.partition(" ")
+    name, at, bot = token.lower().partition("@")
+    return ALIASES[name] + at + bot + space + rest if name in ALIASES else message
+
+
+def route(text, in_game):
+    parsed = ROUTER.route(text, in_game)
+    return None if parsed is None else (parsed.command.name, parsed.arguments)
+
+
+def random_message(rng):
+    """ A command token, maybe addressed to a bot, followed by a space
+        and random arguments that don't start with whitespace.
+    """
+    message = rng.choice(COMMAND_TOKENS) + rng.choice(SUFFIXES)
+    if rng.random() < 0.8:
+        argument = "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 6))).lstrip()
+        if argument:
+            message += " " + argument
+    return message
+
+
+def random_noise(rng):
+    """ Anything at all, including whitespace everywhere. """
+    return "".join(rng.choice(PIECES + COMMAND_TOKENS + SUFFIXES) for _ in range(rng.randint(0, 8)))
+
+
+def fuzz(n, seed=0):
+    rng = random.Random(seed)
+    mismatches = 0
+
+    for _ in range(n):
+        in_game = rng.random() < 0.5
+        message = random_message(rng)
+        routed, expected = route(message, in_game), legacy_route(unalias(message), in_game)
+        if routed != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                print("mismatch (in_game=%s): %r routes to %r, was %r" % (in_game, message, routed, expected))
+
+        # It may route noise differently from the old chain, but never raise
+        route(random_noise(rng), in_game)
+
+    print("fuzzed %d messages and %d noisy ones: %d mismatches" % (n, n, mismatches))
+    return mismatches
+
+
+def messages_per_second(function, corpus):
+    start = time.perf_counter()
+    for text, in_game in corpus:
+        function(text, in_game)
+    return len(corpus) / (time.perf_counter() - start)
+
+
+def bench(n, seed=0):
+    """ Mostly chatter, as in a real group chat, with some commands. """
+    rng = random.Random(seed)
+    corpus = [(rng.choice(CHATTER) if rng.random() < 0.8 else random_message(rng), rng.random() < 0.5)
+              for _ in range(n)]
+
+    legacy = messages_per_second(legacy_route, corpus)
+    routed = messages_per_second(ROUTER.route, corpus)
+    print("%d messages: legacy %.0f/s, router %.0f/s (%.2fx)" % (n, legacy, routed, routed / legacy))
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog="bench_commands.py", description="Fuzz and benchmark the command router")
+    parser.add_argument("--fuzz", type=int, default=100000, metavar="N", help="messages to fuzz")
+    parser.add_argument("--bench", type=int, default=1000000, metavar="N", help="messages to route")
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args(args)
+
+    mismatches = fuzz(options.fuzz, options.seed) if options.fuzz else 0
+    if options.bench:
+        bench(options.bench, options.seed)
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+# coding=utf-8
+""" Insults per second of the compiled grammars against the
+    reference CFG.gen_random_convergent, for every mode.
+
+    Usage: python bench_insults.py [insults per mode]
+"""
+import json
+import random
+import re
+import sys
+import time
+
+from insults import INSULTS_FILE, build_grammars
+
+
+def reference_insult(cfg):
+    """ The generation path Insulter used before grammars were compiled. """
+    return re.sub(r'\s+([?,.!"])', r'\1', cfg.gen_random_convergent("S")).strip()
+
+
+def compiled_insult(cfg):
+    return cfg.compile().gen_random("S")
+
+
+def insults_per_second(generate, cfg, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        generate(cfg)
+    return n / (time.perf_counter() - start)
+
+
+def same_output(cfg, n, seed=0):
+    """ Both engines consume random numbers in the same order,
+        so with the same seed they must produce the same insults.
+    """
+    random.seed(seed)
+    expected = [reference_insult(cfg) for _ in range(n)]
+    random.seed(seed)
+    return expected == [compiled_insult(cfg) for _ in range(n)]
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    n = int(args[0]) if args else 20000
+
+    # The reference needs the grammars themselves, not their compiled form
+    with open(INSULTS_FILE, encoding="utf8") as file_obj:
+        grammars = build_grammars(json.load(file_obj))
+
+    print("%-12s %14s %14s %8s %6s" % ("mode", "reference/s", "compiled/s", "speedup", "same"))
+    for mode, cfg in grammars.items():
+        reference = insults_per_second(reference_insult, cfg, n)
+        compiled = insults_per_second(compiled_insult, cfg, n)
+        print("%-12s %14.0f %14.0f %7.2fx %6s" %
+              (mode, reference, compiled, compiled / reference, same_output(cfg, 1000)))
+
+
+if __name__ == "__main__":
+    main()
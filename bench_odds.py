@@ -0,0 +1,62 @@
+""" Odds per second for rosters of every size: convolved in plain
+    Python, transformed with numpy (when it's installed), and through
+    the engine's cache, as hundreds of games asking at once would.
+
+    Usage: python bench_odds.py [rosters per size]
+"""
+import random
+import sys
+import time
+
+from probability import Engine, RATE_STEPS, convolve, load_numpy, transform
+
+SIZES = (2, 5, 10, 20, 50, 100)
+# Players answering, with their histories, in the games being played
+POPULATION = 2000
+# Times a game asks about its roster: once per guess, and for hints
+ASKS = 5
+
+
+def per_second(compute, rosters):
+    start = time.perf_counter()
+    for rates in rosters:
+        compute(rates)
+    return len(rosters) / (time.perf_counter() - start)
+
+
+def largest_difference(rosters, numpy):
+    return max(max(abs(a - b) for a, b in zip(convolve(rates), transform(rates, numpy))) for rates in rosters)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    n = int(args[0]) if args else 2000
+    rng = random.Random(0)
+    numpy = load_numpy()
+
+    engine = Engine()
+    for player in range(POPULATION):
+        rate = rng.random()
+        for _ in range(rng.randint(0, 30)):
+            engine.learn({player: int(rng.random() < rate)})
+
+    print("%-8s %14s %14s %14s %8s %10s" % ("players", "convolve/s", "numpy/s", "engine/s", "hits", "difference"))
+    for size in SIZES:
+        rosters = [[rng.randint(1, RATE_STEPS - 1) / RATE_STEPS for _ in range(size)] for _ in range(n)]
+        games = [rng.sample(range(POPULATION), size) for _ in range(n // ASKS)]
+        # Interleaved, as games take turns
+        games = [roster for _ in range(ASKS) for roster in games]
+
+        convolved = per_second(convolve, rosters)
+        transformed = per_second(lambda rates: transform(rates, numpy), rosters) if numpy else 0.0
+        hits = engine.hits
+        cached = per_second(engine.odds, games)
+        print("%-8d %14.0f %14.0f %14.0f %7.0f%% %10s" %
+              (size, convolved, transformed, cached, (engine.hits - hits) * 100.0 / len(games),
+               "%.1e" % largest_difference(rosters[:100], numpy) if numpy else "-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+""" Local load test of the webhook server: posts synthetic updates as
+    fast as it can, from many connections at once, to a server feeding
+    a stand-in delegator of DudoHandlers. A share of the requests carry
+    a wrong secret or a broken body, and must be turned away.
+
+    Usage: python bench_webhook.py [--updates N] [--concurrency N] [--port P]
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+import aiohttp
+
+from catalogs import load_catalogs
+from handler import make_bot
+from insults import get_insulter
+from outbox import Outbox
+from sharding import StandInBot, random_update
+from webhook import SECRET_HEADER, WEBHOOK_PATH, WebhookServer, bot_handler, new_secret
+
+BAD_SECRET_RATE = 0.01
+MALFORMED_RATE = 0.005
+
+
+async def post_all(url, secret, requests, concurrency):
+    """ Posts (kind, body) requests over concurrency connections.
+        Returns the latency and status of each one, by kind.
+    """
+    results = []
+    requests = iter(requests)
+
+    async def poster(session):
+        for kind, body in requests:
+            headers = {SECRET_HEADER: secret if kind != "bad secret" else new_secret(),
+                       "Content-Type": "application/json"}
+            start = time.perf_counter()
+            async with session.post(url, data=body, headers=headers) as response:
+                await response.read()
+                results.append((kind, response.status, time.perf_counter() - start))
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(poster(session) for _ in range(concurrency)))
+    return results
+
+
+def synthetic_requests(n, chats, seed=0):
+    rng = random.Random(seed)
+    for update_id in range(1, n + 1):
+        choice = rng.random()
+        if choice < BAD_SECRET_RATE:
+            yield "bad secret", json.dumps(random_update(rng, update_id, chats))
+        elif choice < BAD_SECRET_RATE + MALFORMED_RATE:
+            yield "malformed", '{"update_id": %d, ' % update_id
+        else:
+            yield "update", json.dumps(random_update(rng, update_id, chats))
+
+
+async def bench(n, concurrency, chats, port):
+    get_insulter().fill_pools()
+    load_catalogs()
+
+    secret = new_secret()
+    bot = make_bot("", Outbox(), bot_class=StandInBot)
+    feed = bot_handler(bot)
+    handled = []
+
+    def handle(update):
+        handled.append(update["update_id"])
+        feed(update)
+
+    server = WebhookServer(handle, secret, max_concurrency=concurrency)
+    await server.start("127.0.0.1", port)
+    try:
+        start = time.perf_counter()
+        results = await post_all("http://127.0.0.1:%d%s" % (port, WEBHOOK_PATH), secret,
+                                 synthetic_requests(n, chats), concurrency)
+        elapsed = time.perf_counter() - start
+    finally:
+        await server.stop()
+
+    expected = {"update": 200, "bad secret": 401, "malformed": 400}
+    wrong = [(kind, status) for kind, status, _ in results if status != expected[kind]]
+    latencies = sorted(latency for _, _, latency in results)
+    sent = sum(1 for kind, _, _ in results if kind == "update")
+
+    print("%d requests in %.2fs: %.0f requests/s over %d connections" % (n, elapsed, n / elapsed, concurrency))
+    print("latency: p50 %.2f ms, p99 %.2f ms" %
+          (latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+    print("server: %(accepted)d accepted, %(rejected)d rejected, %(malformed)d malformed" % server.stats())
+    print("delegator: %d of %d updates handled, %d wrong statuses" % (len(handled), sent, len(wrong)))
+    return 0 if not wrong and len(handled) == sent else 1
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog="bench_webhook.py", description="Load test the webhook server")
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=50, help="connections posting at once")
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8765)
+    options = parser.parse_args(args)
+
+    return asyncio.get_event_loop().run_until_complete(
+        bench(options.updates, options.concurrency, options.chats, options.port))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import ast
+import gettext
+import io
+import os
+import struct
+from array import array
+
+LOCALE_DIR = "translations"
+DOMAIN = "dudobot"
+DEFAULT_LOCALE = "en"
+
+_catalogs = dict()
+
+
+def get_catalog(locale):
+    """ Returns the shared translations for locale, falling
+        back to the default one. Catalogs are loaded once, on
+        first use, and never touch the filesystem afterwards.
+    """
+    if not _catalogs:
+        load_catalogs()
+
+    catalog = _catalogs.get(locale)
+    if catalog is None:
+        catalog = _catalogs[DEFAULT_LOCALE]
+    return catalog
+
+
+def available_locales():
+    if not _catalogs:
+        load_catalogs()
+    return sorted(_catalogs.keys())
+
+
+def load_catalogs(localedir=LOCALE_DIR, domain=DOMAIN):
+    """ Compiles (or loads the cached compilation of) every
+        catalog under localedir. Messages are in English in
+        the source, so the default locale needs no catalog.
+    """
+    _catalogs.clear()
+    _catalogs[DEFAULT_LOCALE] = gettext.NullTranslations()
+
+    if not os.path.isdir(localedir):
+        return
+
+    for locale in os.listdir(localedir):
+        po_path = os.path.join(localedir, locale, "LC_MESSAGES", domain + ".po")
+        if os.path.isfile(po_path):
+            _catalogs[locale] = load_catalog(po_path)
+
+
+def load_catalog(po_path):
+    """ Loads the .mo next to po_path, compiling it first if it
+        is missing or older than the .po. If it can't be written
+        the compiled catalog is only kept in memory.
+    """
+    mo_path = os.path.splitext(po_path)[0] + ".mo"
+
+    if not os.path.isfile(mo_path) or os.path.getmtime(mo_path) < os.path.getmtime(po_path):
+        mo_data = compile_po(po_path)
+        # Workers may all be compiling it at once, each renames its own copy
+        temporary = "%s.%d.tmp" % (mo_path, os.getpid())
+        try:
+            with open(temporary, "wb") as mo_file:
+                mo_file.write(mo_data)
+            os.replace(temporary, mo_path)
+        except OSError:
+            pass
+        return gettext.GNUTranslations(io.BytesIO(mo_data))
+
+    with open(mo_path, "rb") as mo_file:
+        return gettext.GNUTranslations(mo_file)
+
+
+def compile_po(po_path):
+    """ Compiles a .po file to .mo data, like msgfmt does:
+        fuzzy and untranslated entries are left out.
+    """
+    with open(po_path, encoding="utf8") as po_file:
+        messages = parse_po(po_file)
+
+    keys = sorted(messages)
+    ids = b""
+    strs = b""
+    offsets = []
+    for key in keys:
+        value = messages[key]
+        offsets.append((len(ids), len(key), len(strs), len(value)))
+        ids += key + b"\0"
+        strs += value + b"\0"
+
+    # The header is followed by the key table and the value table
+    key_start = 7 * 4 + 16 * len(keys)
+    value_start = key_start + len(ids)
+    key_offsets = []
+    value_offsets = []
+    for id_offset, id_length, str_offset, str_length in offsets:
+        key_offsets += [id_length, id_offset + key_start]
+        value_offsets += [str_length, str_offset + value_start]
+
+    header = struct.pack("Iiiiiii", 0x950412de, 0, len(keys), 7 * 4, 7 * 4 + len(keys) * 8, 0, 0)
+    return header + array("i", key_offsets).tobytes() + array("i", value_offsets).tobytes() + ids + strs
+
+
+def parse_po(lines):
+    """ Returns the translated messages of a .po file as a
+        dict of encoded msgid -> msgstr.
+    """
+    messages = dict()
+    entry = dict()
+    field = None
+    fuzzy = False
+
+    def add_entry():
+        if "msgid" in entry and not fuzzy:
+            msgid = entry["msgid"]
+            if "msgctxt" in entry:
+                msgid = entry["msgctxt"] + "\x04" + msgid
+            if "msgid_plural" in entry:
+                msgid += "\0" + entry["msgid_plural"]
+                msgstr = "\0".join(entry[key] for key in sorted(entry) if key.startswith("msgstr["))
+            else:
+                msgstr = entry.get("msgstr", "")
+            if msgstr:
+                messages[msgid.encode("utf8")] = msgstr.encode("utf8")
+
+    for line in lines:
+        line = line.strip()
+
+        if line.startswith("#"):
+            if line.startswith("#,") and "fuzzy" in line:
+                if any(key.startswith("msgstr") for key in entry):
+                    add_entry()
+                    entry = dict()
+                fuzzy = True
+            continue
+
+        if not line:
+            continue
+
+        if line.startswith('"'):
+            entry[field] += ast.literal_eval(line)
+            continue
+
+        keyword, value = line.split(None, 1)
+        if keyword in ("msgctxt", "msgid") and any(key.startswith("msgstr") for key in entry):
+            add_entry()
+            entry = dict()
+            fuzzy = False
+
+        field = keyword
+        entry[field] = ast.literal_eval(value)
+
+    add_entry()
+    return messages
+
@@ -0,0 +1,103 @@
+""" The commands the bot understands, as a table. Each message is
+    tokenized once: its first token picks the command, and the rest
+    of the text is handed to that command's parser.
+"""
+from collections import namedtuple
+
+from actions import AddAI, Doubt, Fit, Flee, Join, MakeBet, MakeQuestion
+
+BOT_NAME = "@du2bot"
+
+# When a command is understood: with no game in the chat, during one, or both
+NO_GAME = 1
+IN_GAME = 2
+ANY_TIME = NO_GAME | IN_GAME
+
+# parse(argument) returns the command's arguments as a tuple, or None if
+# they are invalid. action(player, player_name, *arguments) builds the
+# PlayerAction to apply; commands without one are run by the handler.
+Command = namedtuple("Command", "name parse action when aliases")
+Parsed = namedtuple("Parsed", "command arguments")
+
+
+def no_arguments(argument):
+    return ()
+
+
+def parse_question(argument):
+    """ "question ## n", where n is the initial bet. Anything else is
+        (None, None), which the game answers as an invalid question.
+    """
+    tokens = argument.split("##", 1)
+    if len(tokens) < 2:
+        return None, None
+
+    try:
+        return tokens[0], int(tokens[1])
+    except ValueError:
+        return None, None
+
+
+def parse_bet(argument):
+    try:
+        return int(argument),
+    except ValueError:
+        return None
+
+
+def parse_locale(argument):
+    tokens = argument.split(None, 1)
+    return (tokens[0] if tokens else None),
+
+
+COMMANDS = (
+    Command("/startgame", no_arguments, None, NO_GAME, ()),
+    Command("/help", no_arguments, None, NO_GAME, ()),
+    Command("/stats", no_arguments, None, ANY_TIME, ()),
+    Command("/language", parse_locale, None, ANY_TIME, ("/lang",)),
+    Command("/endgame", no_arguments, None, IN_GAME, ()),
+    Command("/join", no_arguments, lambda player, name: Join(player, name), IN_GAME, ()),
+    Command("/addbot", no_arguments, lambda player, name: AddAI(player), IN_GAME, ()),
+    Command("/flee", no_arguments, lambda player, name: Flee(player), IN_GAME, ()),
+    Command("/ask", parse_question,
+            lambda player, name, question, initial_bet: MakeQuestion(player, question, initial_bet), IN_GAME, ()),
+    Command("/raise", parse_bet, lambda player, name, bet: MakeBet(player, bet), IN_GAME, ("/bet",)),
+    Command("/dudo", no_arguments, lambda player, name: Doubt(player), IN_GAME, ("/doubt",)),
+    Command("/calzo", no_arguments, lambda player, name: Fit(player), IN_GAME, ("/calza", "/fit")),
+    Command("/hint", no_arguments, None, IN_GAME, ()),
+)
+
+
+class Router:
+    """ Maps command names and their aliases, optionally addressed to
+        the bot as /command@du2bot, to their Command. Plain chatter and
+        commands for other bots are turned away on the first token.
+    """
+
+    def __init__(self, commands=COMMANDS, bot_name=BOT_NAME):
+        self.bot = bot_name.lower().lstrip("@")
+        self.table = dict()
+        for command in commands:
+            for name in (command.name,) + command.aliases:
+                self.table[name] = command
+
+    def route(self, text, in_game):
+        """ Returns the Parsed command in text, or None if there isn't
+            one that can be used with or without a game, as in_game says.
+        """
+        tokens = text.split(None, 1)
+        if not tokens or tokens[0][0] != "/":
+            return None
+
+        name, at, bot = tokens[0].lower().partition("@")
+        if at and bot != self.bot:
+            return None
+
+        command = self.table.get(name)
+        if command is None or not command.when & (IN_GAME if in_game else NO_GAME):
+            return None
+
+        return Parsed(command, command.parse(tokens[1] if len(tokens) > 1 else ""))
+
+
+ROUTER = Router()
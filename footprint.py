@@ -0,0 +1,96 @@
+""" Memory budget of a game: bytes per idle game (waiting for players,
+    one joined) and per active game (everyone joined and voted, waiting
+    for a guess), plus bytes per incoming action, measured with
+    tracemalloc over many games built side by side.
+
+    Usage: python footprint.py [--games N] [--players N]
+"""
+import argparse
+import asyncio
+import sys
+import tracemalloc
+
+from actions import Answer, Join, MakeQuestion
+from replay import run_sync
+from statemachine import DudoStateMachine
+from timers import TimingWheel
+
+
+class NullSender:
+    __slots__ = ()
+
+    async def sendMessage(self, text, **kwargs):
+        return {"message_id": 1}
+
+    async def editMessageText(self, message_id, text, **kwargs):
+        pass
+
+
+def build_game(make_game, chat_id, players, active):
+    game = make_game(chat_id)
+    game.start()
+    game.on_input(Join(1, "Player 1"))
+    if active:
+        for player in range(2, players + 1):
+            game.on_input(Join(player, "Player %d" % player))
+        game.current_state.on_timeout(game)
+        game.on_input(MakeQuestion(game.questioners.current, "Question?", 1))
+        for player in range(1, players + 1):
+            game.on_input(Answer(player, player % 2))
+    run_sync(game.force_announce())
+    return game
+
+
+def allocated(build, n):
+    """ Bytes allocated per item by build(index), kept alive meanwhile. """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    items = [build(index) for index in range(n)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return size / n, items
+
+
+def measure(make_game, n=1000, players=5):
+    """ Returns bytes per idle game and per active game. make_game(chat_id)
+        must return a fresh DudoStateMachine; it's called from whatever
+        event loop is current, which isn't run.
+    """
+    # Warm up the shared insulter, catalogs and wheel outside the measurement
+    build_game(make_game, 0, players, True).destroy()
+
+    sizes = []
+    for active in (False, True):
+        size, games = allocated(lambda index: build_game(make_game, -index - 1, players, active), n)
+        sizes.append(size)
+        for game in games:
+            game.destroy()
+    return sizes
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog="footprint.py", description="Report the memory used per game")
+    parser.add_argument("--games", type=int, default=1000, help="games to build for each measurement")
+    parser.add_argument("--players", type=int, default=5, help="players per active game")
+    options = parser.parse_args(args)
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    wheel = TimingWheel()
+    sender = NullSender()
+
+    idle, active = measure(lambda chat_id: DudoStateMachine(sender, chat_id, wheel=wheel),
+                           options.games, options.players)
+    action, _ = allocated(lambda index: Answer(index, index % 2), options.games * 10)
+
+    print("idle game:    %6.0f bytes" % idle)
+    print("active game:  %6.0f bytes (%d players)" % (active, options.players))
+    print("action:       %6.0f bytes" % action)
+    print("games per GB: %6.0f idle, %.0f active" % (2 ** 30 / idle, 2 ** 30 / active))
+
+
+if __name__ == "__main__":
+    main()
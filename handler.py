@@ -1,37 +1,68 @@
+import asyncio
 import logging
-import sys
 
 import telepot
+import telepot.aio
+from telepot.aio.delegate import pave_event_space, per_chat_id, create_open, include_callback_query_chat_id
 from telepot.aio.helper import ChatHandler
 
-from actions import *
+from actions import Answer, Join
+from actor import GameActor
+from catalogs import DEFAULT_LOCALE, available_locales
+from commands import ROUTER
+from metrics import METRICS
+from probability import ENGINE
 from statemachine import DudoStateMachine
+from states import State
+from timers import get_wheel
 
-BOT_NAME = "@du2bot"
+# Only games waiting for someone to start something are put to sleep
+HIBERNATING_STATES = (State.waiting_for_players, State.waiting_for_question)
+# Seconds of silence after which a chat's handler is closed
+HANDLER_TIMEOUT = 300
 
 
 class DudoHandler(ChatHandler):
-    def __init__(self, *args, **kwargs):
+    # Commands that aren't game actions, by the method that runs them
+    runners = {
+        "/startgame": "start_game",
+        "/help": "show_help",
+        "/stats": "show_stats",
+        "/language": "set_locale",
+        "/endgame": "end_game",
+        "/hint": "show_hint",
+    }
+
+    def __init__(self, *args, outbox=None, edit_in_place=False, journal=None, hibernator=None, stats=None,
+                 **kwargs):
         super(DudoHandler, self).__init__(*args, **kwargs)
 
-        self.logger = logging.getLogger("dudo.handler")
-        self.logger.setLevel(logging.DEBUG)
-        self.handler = logging.StreamHandler(sys.stdout)
-        self.handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.handler.setFormatter(formatter)
-        self.logger.addHandler(self.handler)
+        self.logger = logging.LoggerAdapter(logging.getLogger("dudo.handler"), {"chat_id": self.chat_id})
 
-        self.context = None
+        # Everything we send goes through the outbox when there is one
+        self.messenger = self.sender if outbox is None else outbox.sender(self.bot, self.chat_id)
+        # Plain senders can't edit messages
+        self.edit_in_place = edit_in_place and outbox is not None
+
+        self.journal = journal
+        self.context = None if journal is None else journal.adopt(self.chat_id)
+        self.locale = DEFAULT_LOCALE if self.context is None else self.context.locale
+
+        self.stats = stats
+
+        self.hibernator = hibernator
+        self.last_activity = 0.0
+        self.idle_timer = None
+        if hibernator is not None and self.context is not None:
+            # The journal knows better, it has whatever happened after
+            hibernator.forget(self.chat_id)
 
         logger = self.logger
 
         async def on_close(e):
             logger.debug("Dying...")
             if self.context is not None and not self.context.dead:
-                self.context.destroy()
-                self.logger.removeHandler(self.handler)
-                await self.sender.sendMessage("You've been silent for too long. See ya next time!")
+                self.context.actor.post(self.retire, self.context)
 
         self.on_close = on_close
 
@@ -44,128 +75,182 @@ class DudoHandler(ChatHandler):
         if content_type != "text":
             return
 
-        text = msg["text"]
-        tokens = text.split()
+        sleeping = self.context is None and self.hibernator is not None and self.hibernator.is_sleeping(self.chat_id)
 
-        if len(tokens) == 0:
+        # Most messages are just chatter, turned away before reaching the game
+        parsed = ROUTER.route(msg["text"], self.context is not None or sleeping)
+        if parsed is None:
             return
 
-        command = tokens[0].lower()
-        if command.endswith(BOT_NAME):
-            command = command[:-len(BOT_NAME)]
+        if sleeping:
+            self.wake()
 
+        command, arguments = parsed
         player = msg["from"]["id"]
         player_name = msg["from"]["first_name"]
 
-        if self.context is None:
-            await self.no_game_command(command, text, player, player_name)
+        if command.action is None:
+            await getattr(self, self.runners[command.name])(player, player_name, *arguments)
+        elif arguments is None:
+            self.context.actor.post(self.context.get_angery)
         else:
-            with await self.context.timeout_lock:
-                await self.handle_command(command, text, player, player_name)
+            self.context.actor.post(self.context.on_input, command.action(player, player_name, *arguments))
+
+        self.touch()
+
+    def new_context(self):
+        context = DudoStateMachine(self.messenger, self.chat_id)
+        context.set_locale(self.locale)
+        context.edit_in_place = self.edit_in_place
+        context.stats = self.stats
+        context.rates = ENGINE
+        return context
+
+    def wake(self):
+        """ Brings the chat's game back from disk, if it's sleeping. """
+        if self.context is None and self.hibernator is not None and self.hibernator.is_sleeping(self.chat_id):
+            self.context = self.hibernator.wake(self.chat_id, self.new_context(), self.journal)
+            self.locale = self.context.locale
+
+    def touch(self):
+        """ Notes activity in a game, which keeps it awake for a while. """
+        if self.hibernator is None or self.context is None:
+            return
+        self.last_activity = asyncio.get_event_loop().time()
+        if self.idle_timer is None:
+            self.idle_timer = get_wheel().schedule(self.hibernator.after, self.check_idle)
 
-        if self.context is not None and self.context.dead:
-            self.context = None
+    def check_idle(self):
+        self.idle_timer = None
+        if self.context is None or self.context.dead:
+            return
 
-    async def no_game_command(self, command, text, player, player_name):
-
-        if command == "/startgame" and self.context is None:
-            self.context = DudoStateMachine(self.sender)
-            with await self.context.timeout_lock:
-                self.context.announce_start(player_name)
-                self.context.start()
-                self.context.on_input(Join(player, player_name))
-                await self.context.force_announce()
-        elif command == "/help":
-            await self.sender.sendMessage(
-                "Available commands are:\n"
-                "\t /startgame\n"
-                "\t /endgame\n"
-                "\t /join\n"
-                "\t /flee\n"
-                "\t /ask question ## n (n being the initial bet)\n"
-                "\t /raise n (raise the bet to an integer n > 0)\n"
-                "\t /calzo\n"
-                "\t /dudo\n"
-                "\t /help"
-            )
-
-    async def handle_command(self, command, text, player, player_name):
-
-        current_input = None
-        if command == "/join":
-            current_input = Join(player, player_name)
-        elif command == "/flee":
-            current_input = Flee(player)
-        elif command == "/ask":
-
-            question, initial_bet = self.parse_question(text)
-            current_input = MakeQuestion(player, question, initial_bet)
-
-        elif command == "/raise":
-
-            bet = self.parse_bet(text)
-            if bet is not None:
-                current_input = MakeBet(player, bet)
-            else:
-                self.context.get_angery()
-
-        elif command == "/dudo":
-            current_input = Doubt(player)
-        elif command == "/calzo":
-            current_input = Fit(player)
-        elif command == "/endgame" and self.context is not None:
-            if self.context.game_owner == player:
-                self.context.announce_cancel(player_name)
-                await self.context.force_announce()
-                self.context.destroy()
-                self.context = None
-                return
+        idle = asyncio.get_event_loop().time() - self.last_activity
+        if idle < self.hibernator.after:
+            self.idle_timer = get_wheel().schedule(self.hibernator.after - idle, self.check_idle)
         else:
+            # After whatever the game still has to do
+            self.context.actor.post(self.hibernate, self.context)
+
+    def retire(self, context):
+        """ Ends the game once its handler is closed for inactivity,
+            or puts it to sleep instead, if it's waiting for someone to
+            start something: hibernating after the handler's own timeout
+            would never happen otherwise.
+        """
+        if context.dead:
             return
 
-        if self.context is not None and current_input is not None:
-            self.context.on_input(current_input)
+        if self.hibernator is not None and context.current_state in HIBERNATING_STATES:
+            self.hibernator.hibernate(context)
+        else:
+            context.destroy()
+            context.announce("You've been silent for too long. See ya next time!")
+        self.context = None
 
-        if self.context is not None:
-            await self.context.force_announce()
+    def hibernate(self, context):
+        if context is not self.context or context.dead:
+            return
 
-    async def on_callback_query(self, msg):
-        query_id, from_id, query_data = telepot.glance(msg, flavor='callback_query')
+        if context.current_state not in HIBERNATING_STATES or \
+                asyncio.get_event_loop().time() - self.last_activity < self.hibernator.after:
+            self.idle_timer = get_wheel().schedule(self.hibernator.after, self.check_idle)
+            return
 
-        if self.context is not None:
-            val_to_add = 1 if query_data == "yes" else 0
+        self.hibernator.hibernate(context)
+        self.context = None
 
-            with await self.context.timeout_lock:
-                self.context.on_input(Answer(from_id, val_to_add))
-                await self.context.force_announce()
+    async def start_game(self, player, player_name):
+        self.context = self.new_context()
+        # Nothing else knows about the game yet, so it can be set up in place
+        self.context.announce_start(player_name)
+        self.context.start()
+        if self.journal is not None:
+            self.journal.start_game(self.context)
+        self.context.actor.post(self.context.on_input, Join(player, player_name))
+
+    async def show_help(self, player, player_name):
+        await self.messenger.sendMessage(
+            "Available commands are:\n"
+            "\t /startgame\n"
+            "\t /endgame\n"
+            "\t /join\n"
+            "\t /addbot (have a robot join)\n"
+            "\t /flee\n"
+            "\t /ask question ## n (n being the initial bet)\n"
+            "\t /raise n (raise the bet to an integer n > 0, or /bet n)\n"
+            "\t /calzo (or /calza, /fit)\n"
+            "\t /dudo (or /doubt)\n"
+            "\t /hint (odds of the current bet)\n"
+            "\t /language code (one of %s)\n"
+            "\t /stats\n"
+            "\t /help" % ", ".join(available_locales())
+        )
+
+    async def show_stats(self, player, player_name):
+        if self.stats is None:
+            await self.messenger.sendMessage("Stats are not being kept.")
+            return
 
-    @staticmethod
-    def parse_question(text):
-        if len(text.split(" ", 1)) <= 1:
-            return None, None
+        totals = await self.stats.lookup(player)
+        if totals is None:
+            await self.messenger.sendMessage("%s hasn't finished a round yet." % player_name)
+        else:
+            await self.messenger.sendMessage("%s: %d won, %d lost, %d doubts, %d fits." %
+                                             (player_name, totals.wins, totals.losses, totals.doubts, totals.fits))
 
-        text = text.split(" ", 1)[1]
+    async def set_locale(self, player, player_name, locale):
+        if locale not in available_locales():
+            await self.messenger.sendMessage("Available languages are: %s" % ", ".join(available_locales()))
+            return
 
-        tokens = text.split("##", 1)
+        self.locale = locale
+        if self.context is not None:
+            self.context.actor.post(self.context.set_locale, self.locale)
+        await self.messenger.sendMessage("Language set to %s." % self.locale)
 
-        if len(tokens) < 2:
-            return None, None
+    async def end_game(self, player, player_name):
+        self.context.actor.post(self.context.cancel, player, player_name)
 
-        try:
-            question = tokens[0]
-            initial_bet = int(tokens[1])
+    async def show_hint(self, player, player_name):
+        self.context.actor.post(self.context.give_hint)
 
-            return question, initial_bet
+    async def on_callback_query(self, msg):
+        query_id, from_id, query_data = telepot.glance(msg, flavor='callback_query')
 
-        except ValueError:
-            return None, None
+        self.wake()
+        if self.context is not None:
+            val_to_add = 1 if query_data == "yes" else 0
 
-    @staticmethod
-    def parse_bet(text):
-        try:
-            text = text.split(" ", 1)[1]
-            return int(text)
-        except ValueError:
-            return None
-        except IndexError:
-            return None
+            self.context.actor.post(self.context.on_input, Answer(from_id, val_to_add))
+            self.touch()
+
+
+def make_bot(token, outbox, journal=None, edit_in_place=False, bot_class=None, hibernator=None, stats=None):
+    """ A DelegatorBot (or bot_class) handing each group chat to its own
+        DudoHandler. Games left in the journal are recovered first.
+    """
+    bot = (telepot.aio.DelegatorBot if bot_class is None else bot_class)(token, [
+        include_callback_query_chat_id(pave_event_space())(
+            per_chat_id(types=["group"]), create_open, DudoHandler, timeout=HANDLER_TIMEOUT,
+            outbox=outbox, edit_in_place=edit_in_place, journal=journal, hibernator=hibernator, stats=stats),
+    ])
+
+    def make_context(chat_id):
+        context = DudoStateMachine(outbox.sender(bot, chat_id), chat_id)
+        context.edit_in_place = edit_in_place
+        context.stats = stats
+        context.rates = ENGINE
+        return context
+
+    if journal is not None:
+        journal.recover(make_context)
+
+    METRICS.collect("dudo_outbox", outbox.stats, counters=("sent", "failed", "retries"))
+    METRICS.collect("dudo_timers", get_wheel().stats, counters=("armed", "cancelled", "fired"))
+    METRICS.collect("dudo_actor", GameActor.stats, counters=("inputs", "batches"))
+    METRICS.collect("dudo_odds", ENGINE.stats, counters=("hits", "misses"))
+    if stats is not None:
+        METRICS.collect("dudo_stats", stats.stats, counters=("hits", "misses", "flushes"))
+
+    return bot
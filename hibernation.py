@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import time
+import zlib
+
+HIBERNATION_DIR = "hibernated"
+SUFFIX = ".json.z"
+
+# Games nobody came back to for this long are forgotten
+MAX_SLEEP = 7 * 24 * 3600
+
+
+class Hibernator:
+    """ Keeps idle games on disk instead of in memory, one compressed
+        snapshot per chat, and brings them back when the chat speaks
+        again. A sleeping game's timeout is frozen: it gets whatever
+        was left of it when it wakes up. Sleeping games are not in the
+        journal; they go back in when they wake.
+    """
+
+    def __init__(self, after, directory=HIBERNATION_DIR, max_sleep=MAX_SLEEP):
+        self.logger = logging.getLogger("dudo.hibernation")
+        self.after = after
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        now = time.time()
+        for file_name in os.listdir(directory):
+            path = os.path.join(directory, file_name)
+            if file_name.endswith(SUFFIX) and os.path.getmtime(path) < now - max_sleep:
+                os.remove(path)
+
+    def path(self, chat_id):
+        return os.path.join(self.directory, "%d%s" % (chat_id, SUFFIX))
+
+    def is_sleeping(self, chat_id):
+        # Asked of the disk, not remembered: workers share the directory,
+        # and a chat moves to another one when its worker is dropped
+        return os.path.exists(self.path(chat_id))
+
+    def hibernate(self, context):
+        """ Writes the game to disk. The caller must drop it afterwards. """
+        # Before the timeout is cancelled, so that what's left of it is in the snapshot
+        data = zlib.compress(json.dumps(context.snapshot(), separators=(",", ":")).encode("utf8"))
+        context.cancel_timeout()
+
+        path = self.path(context.chat_id)
+        with open(path + ".tmp", "wb") as snapshot_file:
+            snapshot_file.write(data)
+        os.replace(path + ".tmp", path)
+
+        if context.journal is not None:
+            context.journal.end_game(context)
+        # The copy on disk is the game now; this one only waits to be collected
+        context.dead = True
+        self.logger.info("Game %s of chat %s went to sleep in %d bytes", context.game_id, context.chat_id, len(data))
+
+    def wake(self, chat_id, context, journal=None):
+        """ Restores the chat's sleeping game into a fresh context. """
+        path = self.path(chat_id)
+        with open(path, "rb") as snapshot_file:
+            snapshot = json.loads(zlib.decompress(snapshot_file.read()).decode("utf8"))
+        self.forget(chat_id)
+
+        context.restore(snapshot)
+        if journal is not None:
+            journal.start_game(context)
+        self.logger.info("Game %s of chat %s woke up", context.game_id, chat_id)
+        return context
+
+    def forget(self, chat_id):
+        try:
+            os.remove(self.path(chat_id))
+        except FileNotFoundError:
+            pass
@@ -1,112 +1,311 @@
 # coding=utf-8
+import asyncio
+import hashlib
 import json
+import logging
+import marshal
+import os
 import random
-import re
-from collections import defaultdict
+import sys
+from bisect import bisect_right
+from collections import defaultdict, deque
+from itertools import accumulate
+from time import perf_counter
+from types import MappingProxyType
+
+from metrics import METRICS
+
+INSULTS_FILE = "insults.json"
+# Compiled grammars are cached next to the corpus, as insults.cache
+CACHE_SUFFIX = ".cache"
+
+# Ready-made insults kept per mode, and how many are generated per refill step
+POOL_SIZE = 32
+REFILL_BATCH = 4
+
+# Terminals starting with one of these are glued to the previous token
+PUNCTUATION = frozenset('?,.!"')
+
+_shared_insulters = dict()
+
+
+def get_insulter(file_name=INSULTS_FILE):
+    """ Returns the process-wide Insulter for file_name,
+        loading it on first use. Grammars are immutable
+        once loaded, so every game can share them; only
+        the mode and anger level vary per game.
+    """
+    insulter = _shared_insulters.get(file_name)
+    if insulter is None:
+        insulter = Insulter(file_name)
+        insulter.load()
+        _shared_insulters[file_name] = insulter
+    return insulter
+
+
+def build_grammars(insults):
+    """ The grammar of every mode, from the corpus. """
+    soft_cfg = CFG()
+    # soft insults
+    soft_cfg.add_prod("S", "INTRO INSULT")
+    soft_cfg.add_prod("INTRO", "Oh, you | You")
+    soft_cfg.add_prod("INSULT", "ADJ SIMPLE_NOUN | NOUN")
+
+    soft_cfg.add_prod("NOUN", " | ".join(insults["soft_nouns"]))
+    soft_cfg.add_prod("SIMPLE_NOUN", " | ".join(insults["soft_simple_nouns"]))
+    soft_cfg.add_prod("ADJ", " | ".join(insults["soft_adjectives"]))
+
+    # shakespearean insult
+    shakespeare_cfg = CFG()
+    shakespeare_cfg.add_prod("S", "INTRO ADJ1 , ADJ2 NOUN END")
+    shakespeare_cfg.add_prod("INTRO", "Oh, you | You")
+
+    shakespeare_cfg.add_prod("ADJ1", " | ".join(insults["old_adjectives_one"]))
+    shakespeare_cfg.add_prod("ADJ2", " | ".join(insults["old_adjectives_two"]))
+    shakespeare_cfg.add_prod("NOUN", " | ".join(insults["old_nouns"]))
+    shakespeare_cfg.add_prod("END", ". | !")
+
+    # pythonic insult
+    python_cfg = CFG()
+    python_cfg.add_prod("S", "EXCLAMATION | INSULT END")
+    python_cfg.add_prod("INSULT", "INTRO _2ADJECTIVE NOUN")
+
+    python_cfg.bind("2ADJECTIVE", JoinedSample(insults["adjectives"], 2))
+
+    python_cfg.add_prod("INTRO", "Oh, you | You")
+
+    python_cfg.add_prod("EXCLAMATION",
+                        "I ACTION , you ADJECTIVE NOUN END | ORDER , you ADJECTIVE NOUN END")
+    python_cfg.add_prod("ORDER", "Go and boil your bottoms | Cut your prancing or I shall taunt you a second time")
+    python_cfg.add_prod("ACTION",
+                        "blow my nose at you | fart in your general direction | burst my pimples at you | "
+                        "unclog my nose in your direction | wave my private parts at your aunties")
+
+    python_cfg.add_prod("ADJECTIVE", " | ".join(insults["python_adjectives"]))
+    python_cfg.add_prod("NOUN", " | ".join(insults["python_nouns"]))
+
+    python_cfg.add_prod("END", ". | !")
+
+    # generic insults
+    normal_cfg = CFG()
+    normal_cfg.add_prod("S", "INTRO ADJ NOUN END| INTRO NOUN END")
+    normal_cfg.add_prod("INTRO", "You | What a | You're such a ")
+    normal_cfg.add_prod("ADJ", "ADJ , ADJ | %s" % " | ".join(insults["adjectives"]))
+    normal_cfg.add_prod("NOUN", " | ".join(insults["nouns"]))
+    normal_cfg.add_prod("END", ". | !")
+
+    trava_cfg = CFG()
+    trava_cfg.add_prod("S", " | ".join(insults["trava_insults"]))
+
+    # chilean!
+    chilean_cfg = CFG()
+    chilean_cfg.add_prod("S",
+                         "Si seguís con eso, podís irte a la PLACE , INSULT . | "
+                         "Este NOUN no es más ADJECTIVE porque no se levanta más temprano .| "
+                         "Puta que es ADJECTIVE este NOUN .")
+
+    chilean_cfg.add_prod("INSULT", "ADJECTIVE NOUN .")
+    chilean_cfg.add_prod("ADJECTIVE", "culiao | reculiao | enfermo | imbécil")
+    chilean_cfg.add_prod("NOUN", "aweonao | weón | engendro | sapo | hijo de WHORE | saco e' weas | chuchetumadre")
+    chilean_cfg.add_prod("WHORE", "puta | maraca | la tragaleche | la comesables")
+    chilean_cfg.add_prod("PLACE", "chucha | mierda | cresta | conchetumadre")
+
+    return {
+        "soft": soft_cfg,
+        "shakespeare": shakespeare_cfg,
+        "python": python_cfg,
+        "normal": normal_cfg,
+        "trava": trava_cfg,
+        "chilean": chilean_cfg,
+    }
+
+
+def grammar_key(corpus):
+    """ Changes whenever the corpus, the grammars built from it in this
+        module, or the marshal format do.
+    """
+    digest = hashlib.sha256(corpus)
+    with open(__file__, "rb") as source_file:
+        digest.update(source_file.read())
+    digest.update(("%s marshal %d" % (sys.implementation.cache_tag, marshal.version)).encode())
+    return digest.hexdigest()
+
+
+def cache_path(file_name):
+    return os.path.splitext(file_name)[0] + CACHE_SUFFIX
 
 
 class Insulter:
-    def __init__(self, file_name):
-        self.file_obj = open(file_name, encoding="utf8")
-        self.insult_cfgs = dict()
+    def __init__(self, file_name, pool_size=POOL_SIZE, cache=True):
+        self.logger = logging.getLogger("dudo.insults")
+        self.file_name = file_name
+        self.cache_file = cache_path(file_name) if cache else None
+        # Compiled grammars, by mode
+        self.insult_cfgs = MappingProxyType(dict())
+
+        self.pool_size = pool_size
+        self.pools = dict()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.refill_handle = None
 
     def __enter__(self):
         self.load()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.file_obj.close()
-        return True
+        if self.refill_handle is not None:
+            self.refill_handle.cancel()
+            self.refill_handle = None
+        return False
 
     def modes(self):
         return list(self.insult_cfgs.keys())
 
     def load(self):
-        insults = json.loads(self.file_obj.read())
-
-        soft_cfg = CFG()
-        # soft insults
-        soft_cfg.add_prod("S", "INTRO INSULT")
-        soft_cfg.add_prod("INTRO", "Oh, you | You")
-        soft_cfg.add_prod("INSULT", "ADJ SIMPLE_NOUN | NOUN")
-
-        soft_cfg.add_prod("NOUN", " | ".join(insults["soft_nouns"]))
-        soft_cfg.add_prod("SIMPLE_NOUN", " | ".join(insults["soft_simple_nouns"]))
-        soft_cfg.add_prod("ADJ", " | ".join(insults["soft_adjectives"]))
-
-        # shakespearean insult
-        shakespeare_cfg = CFG()
-        shakespeare_cfg.add_prod("S", "INTRO ADJ1 , ADJ2 NOUN END")
-        shakespeare_cfg.add_prod("INTRO", "Oh, you | You")
-
-        shakespeare_cfg.add_prod("ADJ1", " | ".join(insults["old_adjectives_one"]))
-        shakespeare_cfg.add_prod("ADJ2", " | ".join(insults["old_adjectives_two"]))
-        shakespeare_cfg.add_prod("NOUN", " | ".join(insults["old_nouns"]))
-        shakespeare_cfg.add_prod("END", ". | !")
-
-        # pythonic insult
-        python_cfg = CFG()
-        python_cfg.add_prod("S", "EXCLAMATION | INSULT END")
-        python_cfg.add_prod("INSULT", "INTRO _2ADJECTIVE NOUN")
-
-        python_cfg.bind("2ADJECTIVE", lambda: ", ".join(random.sample(insults["adjectives"], 2)))
-
-        python_cfg.add_prod("INTRO", "Oh, you | You")
-
-        python_cfg.add_prod("EXCLAMATION",
-                            "I ACTION , you ADJECTIVE NOUN END | ORDER , you ADJECTIVE NOUN END")
-        python_cfg.add_prod("ORDER", "Go and boil your bottoms | Cut your prancing or I shall taunt you a second time")
-        python_cfg.add_prod("ACTION",
-                            "blow my nose at you | fart in your general direction | burst my pimples at you | "
-                            "unclog my nose in your direction | wave my private parts at your aunties")
-
-        python_cfg.add_prod("ADJECTIVE", " | ".join(insults["python_adjectives"]))
-        python_cfg.add_prod("NOUN", " | ".join(insults["python_nouns"]))
-
-        python_cfg.add_prod("END", ". | !")
-
-        # generic insults
-        normal_cfg = CFG()
-        normal_cfg.add_prod("S", "INTRO ADJ NOUN END| INTRO NOUN END")
-        normal_cfg.add_prod("INTRO", "You | What a | You're such a ")
-        normal_cfg.add_prod("ADJ", "ADJ , ADJ | %s" % " | ".join(insults["adjectives"]))
-        normal_cfg.add_prod("NOUN", " | ".join(insults["nouns"]))
-        normal_cfg.add_prod("END", ". | !")
-
-        trava_cfg = CFG()
-        trava_cfg.add_prod("S", " | ".join(insults["trava_insults"]))
-
-        # chilean!
-        chilean_cfg = CFG()
-        chilean_cfg.add_prod("S",
-                             "Si seguís con eso, podís irte a la PLACE , INSULT . | "
-                             "Este NOUN no es más ADJECTIVE porque no se levanta más temprano .| "
-                             "Puta que es ADJECTIVE este NOUN .")
-
-        chilean_cfg.add_prod("INSULT", "ADJECTIVE NOUN .")
-        chilean_cfg.add_prod("ADJECTIVE", "culiao | reculiao | enfermo | imbécil")
-        chilean_cfg.add_prod("NOUN", "aweonao | weón | engendro | sapo | hijo de WHORE | saco e' weas | chuchetumadre")
-        chilean_cfg.add_prod("WHORE", "puta | maraca | la tragaleche | la comesables")
-        chilean_cfg.add_prod("PLACE", "chucha | mierda | cresta | conchetumadre")
-
-        self.insult_cfgs["soft"] = soft_cfg
-        self.insult_cfgs["shakespeare"] = shakespeare_cfg
-        self.insult_cfgs["python"] = python_cfg
-        self.insult_cfgs["normal"] = normal_cfg
-        self.insult_cfgs["trava"] = trava_cfg
-        self.insult_cfgs["chilean"] = chilean_cfg
-
-    def get_insult(self, mode="normal"):
+        """ Loads the compiled grammars from the cache next to the
+            corpus, or builds and caches them when the corpus or this
+            module changed since it was written.
+        """
+        with open(self.file_name, "rb") as file_obj:
+            corpus = file_obj.read()
+        key = grammar_key(corpus)
+
+        grammars = None if self.cache_file is None else self.read_cache(key)
+        if grammars is None:
+            grammars = dict((mode, cfg.compile())
+                            for mode, cfg in build_grammars(json.loads(corpus.decode("utf8"))).items())
+            if self.cache_file is not None:
+                self.write_cache(key, grammars)
+
+        self.insult_cfgs = MappingProxyType(grammars)
+        self.pools = dict((mode, deque(maxlen=self.pool_size)) for mode in self.insult_cfgs)
+
+    def read_cache(self, key):
+        try:
+            # marshal.load reads a file in small pieces, which is far slower
+            with open(self.cache_file, "rb") as cache_file:
+                cached_key, data = marshal.loads(cache_file.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            self.logger.warning("Ignoring broken grammar cache %s: %s", self.cache_file, e)
+            return None
+
+        if cached_key != key:
+            self.logger.info("Grammar cache %s is stale, rebuilding it", self.cache_file)
+            return None
+        return dict((mode, CompiledCFG.from_data(grammar)) for mode, grammar in data.items())
+
+    def write_cache(self, key, grammars):
+        # Workers may all be writing it at once, each renames its own copy
+        temporary = "%s.%d.tmp" % (self.cache_file, os.getpid())
+        try:
+            data = marshal.dumps((key, dict((mode, grammar.to_data()) for mode, grammar in grammars.items())))
+            with open(temporary, "wb") as cache_file:
+                cache_file.write(data)
+            os.replace(temporary, self.cache_file)
+        except (OSError, TypeError, ValueError) as e:
+            self.logger.warning("Could not cache the grammars in %s: %s", self.cache_file, e)
+
+    def get_insult(self, mode="normal", rng=None):
+        """ Pops a ready-made insult for mode. Given a random
+            generator, generates one with it instead, so that
+            seeded callers get reproducible insults.
+        """
         if mode not in self.insult_cfgs:
             mode = "normal"
 
-        return self.insult_cfgs[mode].gen_random("S")
+        if rng is not None:
+            return self.insult_cfgs[mode].gen_random("S", rng=rng)
+
+        pool = self.pools[mode]
+        if pool:
+            self.hits[mode] += 1
+            insult = pool.popleft()
+        else:
+            self.misses[mode] += 1
+            insult = self.generate(mode)
+
+        self.schedule_refill()
+        return insult
+
+    def generate(self, mode):
+        if not METRICS.enabled:
+            return self.insult_cfgs[mode].gen_random("S")
+
+        start = perf_counter()
+        insult = self.insult_cfgs[mode].gen_random("S")
+        METRICS.insult_seconds.observe(perf_counter() - start)
+        return insult
+
+    def fill_pools(self):
+        for mode, pool in self.pools.items():
+            while len(pool) < self.pool_size:
+                pool.append(self.generate(mode))
+
+    def schedule_refill(self):
+        """ Has the pools topped up from the next loop iteration on,
+            a step per iteration, between whatever else the loop has
+            to do; asyncio can't tell when it's idle. Without a
+            running loop they are topped up right away.
+        """
+        if self.refill_handle is not None:
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.fill_pools()
+            return
+        self.refill_handle = loop.call_soon(self._refill, loop)
+
+    def _refill(self, loop):
+        """ Tops up the emptiest pool a few insults at a time,
+            yielding to the loop between steps until all are full.
+        """
+        self.refill_handle = None
+        mode, pool = min(self.pools.items(), key=lambda item: len(item[1]))
+        if len(pool) >= self.pool_size:
+            return
+
+        for _ in range(min(REFILL_BATCH, self.pool_size - len(pool))):
+            pool.append(self.generate(mode))
+
+        self.refill_handle = loop.call_soon(self._refill, loop)
+
+    def pool_stats(self):
+        """ Pool size, hits and misses per mode, for sizing the pools. """
+        return dict((mode, {"size": len(pool), "hits": self.hits[mode], "misses": self.misses[mode]})
+                    for mode, pool in self.pools.items())
+
+
+class JoinedSample(object):
+    """ Bound terminal: k different words, comma separated. Plain
+        data, unlike a lambda, so that it can be cached.
+    """
+    __slots__ = ("words", "k")
+
+    def __init__(self, words, k):
+        self.words = list(words)
+        self.k = k
+
+    def __call__(self, rng=random):
+        return ", ".join(rng.sample(self.words, self.k))
+
+    def to_data(self):
+        return "JoinedSample", self.words, self.k
+
+
+# Bound terminals that compiled grammars can be cached with, by name
+BINDINGS = {"JoinedSample": JoinedSample}
 
 
 class CFG(object):
     def __init__(self):
         self.prod = defaultdict(list)
         self.bound_functions = dict()
+        self.compiled = None
 
     def add_prod(self, lhs, rhs):
         """ Add production to the grammar. 'rhs' can
@@ -121,23 +320,40 @@ class CFG(object):
         prods = rhs.split('|')
         for prod in prods:
             self.prod[lhs].append(tuple(prod.split()))
+        self.compiled = None
 
     def bind(self, binding_id, binding_fun):
+        """ Bind '_binding_id' terminals to a function.
+            The function is called with the random
+            generator in use and must return a string.
+        """
         self.bound_functions[binding_id] = binding_fun
+        self.compiled = None
+
+    def compile(self):
+        if self.compiled is None:
+            self.compiled = CompiledCFG(self)
+        return self.compiled
 
     def gen_random(self,
                    symbol,
-                   cfactor=0.25):
-        return re.sub(r'\s+([?,.!"])', r'\1', self.gen_random_convergent(symbol, cfactor)).strip()
+                   cfactor=0.25,
+                   rng=random):
+        return self.compile().gen_random(symbol, cfactor, rng)
 
     def gen_random_convergent(self,
                               symbol,
                               cfactor=0.25,
-                              pcount=defaultdict(int)
+                              pcount=None
                               ):
         """ Generate a random sentence from the
             grammar, starting with the given symbol.
 
+            This is the reference recursive
+            implementation; gen_random uses the
+            compiled form, which draws the same
+            random numbers in the same order.
+
             Uses a convergent algorithm - productions
             that have already appeared in the
             derivation on each branch have a smaller
@@ -151,6 +367,9 @@ class CFG(object):
             productions that have been used in the
             branch.
         """
+        if pcount is None:
+            pcount = defaultdict(int)
+
         sentence = ''
 
         # The possible productions of this symbol are weighted
@@ -194,6 +413,148 @@ class CFG(object):
         return sentence
 
 
+class CompiledCFG(object):
+    """ Flat form of a CFG. Symbols and productions
+        are mapped to integer ids and sentences are
+        generated iteratively into a token list that
+        is joined once.
+
+        Production items are either symbol ids (int),
+        terminals (str, with their leading space
+        already resolved) or bound functions.
+    """
+
+    def __init__(self, cfg):
+        self.symbol_ids = dict((symbol, i) for i, symbol in enumerate(cfg.prod))
+
+        # Productions are identified by their contents, like
+        # the pcount keys of gen_random_convergent
+        production_ids = dict()
+        self.productions = []
+        self.owners = []
+        self.symbol_prods = []
+        self.cumulative = []
+
+        for symbol, prods in cfg.prod.items():
+            symbol_id = self.symbol_ids[symbol]
+            prod_ids = []
+            for prod in prods:
+                prod_id = production_ids.get(prod)
+                if prod_id is None:
+                    prod_id = production_ids[prod] = len(self.productions)
+                    self.productions.append(tuple(self._compile_item(cfg, sym) for sym in prod))
+                    self.owners.append([])
+                if symbol_id not in self.owners[prod_id]:
+                    self.owners[prod_id].append(symbol_id)
+                prod_ids.append(prod_id)
+
+            self.symbol_prods.append(tuple(prod_ids))
+            self.cumulative.append(list(accumulate([1.0] * len(prod_ids))))
+
+        self.owners = [tuple(owners) for owners in self.owners]
+
+    def to_data(self):
+        """ The grammar as plain data, for marshal. Bound functions must
+            describe themselves with to_data as well.
+        """
+        productions = list(self.productions)
+        bound = []
+        for prod_id, production in enumerate(productions):
+            if any(item.__class__ is not str and item.__class__ is not int for item in production):
+                if not all(item.__class__ in (str, int) or hasattr(item, "to_data") for item in production):
+                    raise TypeError("%r can't be cached" % (production,))
+                productions[prod_id] = tuple(item if item.__class__ in (str, int) else item.to_data()
+                                             for item in production)
+                bound.append(prod_id)
+
+        return {
+            "symbols": list(self.symbol_ids),
+            "productions": productions,
+            "bound": bound,
+            "owners": self.owners,
+            "symbol_prods": self.symbol_prods,
+            "cumulative": self.cumulative,
+        }
+
+    @classmethod
+    def from_data(cls, data):
+        """ Rebuilds a grammar from to_data, binding its functions again. """
+        compiled = cls.__new__(cls)
+        compiled.symbol_ids = dict((symbol, i) for i, symbol in enumerate(data["symbols"]))
+        compiled.productions = productions = data["productions"]
+        # Only the few productions with bound functions need rebuilding
+        for prod_id in data["bound"]:
+            productions[prod_id] = tuple(BINDINGS[item[0]](*item[1:]) if item.__class__ is tuple else item
+                                         for item in productions[prod_id])
+        compiled.owners = data["owners"]
+        compiled.symbol_prods = data["symbol_prods"]
+        compiled.cumulative = data["cumulative"]
+        return compiled
+
+    def _compile_item(self, cfg, sym):
+        if sym in self.symbol_ids:
+            return self.symbol_ids[sym]
+        if sym.startswith("_") and sym[1:] in cfg.bound_functions:
+            return cfg.bound_functions[sym[1:]]
+        return sym if sym[0] in PUNCTUATION else " " + sym
+
+    def gen_random(self, symbol, cfactor=0.25, rng=random):
+        """ Generate a random sentence starting with
+            the given symbol, with the same convergent
+            weighting as CFG.gen_random_convergent.
+        """
+        rand = rng.random
+        productions = self.productions
+        owners = self.owners
+        symbol_prods = self.symbol_prods
+        cumulative = self.cumulative
+
+        # pcount per production, and its sum per symbol: symbols
+        # with no used production keep their precomputed weights
+        pcount = [0] * len(productions)
+        used = [0] * len(symbol_prods)
+
+        def choose(symbol_id):
+            prods = symbol_prods[symbol_id]
+            if used[symbol_id]:
+                cum_weights = list(accumulate([cfactor ** pcount[prod_id] for prod_id in prods]))
+            else:
+                cum_weights = cumulative[symbol_id]
+            idx = bisect_right(cum_weights, rand() * cum_weights[-1])
+            prod_id = prods[min(idx, len(prods) - 1)]
+
+            pcount[prod_id] += 1
+            for owner in owners[prod_id]:
+                used[owner] += 1
+            return prod_id
+
+        tokens = []
+        emit = tokens.append
+
+        prod_id = choose(self.symbol_ids[symbol])
+        stack = [(prod_id, iter(productions[prod_id]))]
+        while stack:
+            prod_id, items = stack[-1]
+            for item in items:
+                if item.__class__ is str:
+                    emit(item)
+                elif item.__class__ is int:
+                    child_id = choose(item)
+                    stack.append((child_id, iter(productions[child_id])))
+                    break
+                else:
+                    text = item(rng)
+                    emit(text if text[:1] in PUNCTUATION else " " + text)
+            else:
+                # backtracking: clear the modification to pcount
+                stack.pop()
+                pcount[prod_id] -= 1
+                for owner in owners[prod_id]:
+                    used[owner] -= 1
+
+        return "".join(tokens).strip()
+
+
 def weighted_choice(weights):
     rnd = random.random() * sum(weights)
     for idx, w in enumerate(weights):
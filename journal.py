@@ -0,0 +1,123 @@
+import json
+import logging
+from collections import defaultdict
+
+from batchwriter import BatchWriter
+
+JOURNAL_FILE = "dudo.db"
+
+# Events are committed in groups, at most this many seconds after they happen
+FLUSH_INTERVAL = 0.05
+SNAPSHOT_EVERY = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    game_id TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    game_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    game_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT,
+    PRIMARY KEY (game_id, seq)
+);
+"""
+
+
+class Journal(BatchWriter):
+    """ Append-only log of every action and timeout applied to each
+        game, in SQLite. Each snapshot of a game replaces the events
+        before it. Games only append statements to the batch.
+    """
+
+    contents = "journal entries"
+
+    def __init__(self, path=JOURNAL_FILE, flush_interval=FLUSH_INTERVAL, snapshot_every=SNAPSHOT_EVERY):
+        self.snapshot_every = snapshot_every
+        self.recovered = dict()
+        BatchWriter.__init__(self, path, SCHEMA, flush_interval, logging.getLogger("dudo.journal"))
+
+    def start_game(self, context):
+        context.journal = self
+        self._append("INSERT OR REPLACE INTO games (game_id, chat_id) VALUES (?, ?)",
+                     (context.game_id, context.chat_id))
+        self.snapshot(context)
+
+    def record(self, context, kind, data):
+        """ Journals an event about to be applied to context. """
+        # Events are recorded before they are applied, so this is the
+        # state after the previous one
+        if context.journal_seq and context.journal_seq % self.snapshot_every == 0:
+            self.snapshot(context)
+
+        context.journal_seq += 1
+        self._append("INSERT INTO events (game_id, seq, kind, data) VALUES (?, ?, ?, ?)",
+                     (context.game_id, context.journal_seq, kind, json.dumps(data)))
+
+    def snapshot(self, context):
+        self._append("INSERT OR REPLACE INTO snapshots (game_id, seq, data) VALUES (?, ?, ?)",
+                     (context.game_id, context.journal_seq, json.dumps(context.snapshot())))
+        # Events up to the snapshot are no longer needed to recover
+        self._append("DELETE FROM events WHERE game_id = ? AND seq <= ?", (context.game_id, context.journal_seq))
+
+    def end_game(self, context):
+        self._append("DELETE FROM games WHERE game_id = ?", (context.game_id,))
+        self._append("DELETE FROM snapshots WHERE game_id = ?", (context.game_id,))
+        self._append("DELETE FROM events WHERE game_id = ?", (context.game_id,))
+
+    def _append(self, statement, parameters):
+        self.pending.append((statement, parameters))
+        self.schedule_flush()
+
+    def new_batch(self):
+        return []
+
+    def write_batch(self, batch):
+        for statement, parameters in batch:
+            self.connection.execute(statement, parameters)
+
+    def recover(self, make_context):
+        """ Rebuilds every game that hadn't ended from its latest
+            snapshot plus the events after it. make_context(chat_id)
+            must return a fresh DudoStateMachine for the chat.
+            Recovered games wait in self.recovered for their handler.
+        """
+        games, snapshots, events = self.read(self._read_live_games).result()
+
+        for game_id, chat_id in games:
+            if game_id not in snapshots:
+                continue
+
+            context = make_context(chat_id)
+            context.restore(json.loads(snapshots[game_id]))
+            context.journal = self
+            context.replay((kind, json.loads(data)) for kind, data in events[game_id])
+
+            if context.dead:
+                continue
+
+            self.logger.info("Recovered game %s in chat %s", game_id, chat_id)
+            self.recovered[chat_id] = context
+
+        return self.recovered
+
+    def _read_live_games(self):
+        games = self.connection.execute("SELECT game_id, chat_id FROM games").fetchall()
+        snapshots = dict(self.connection.execute("SELECT game_id, data FROM snapshots"))
+
+        events = defaultdict(list)
+        for game_id, kind, data in self.connection.execute(
+                "SELECT game_id, kind, data FROM events ORDER BY game_id, seq"):
+            events[game_id].append((kind, data))
+
+        return games, snapshots, events
+
+    def adopt(self, chat_id):
+        """ Hands a recovered game over to its chat's handler. """
+        return self.recovered.pop(chat_id, None)
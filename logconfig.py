@@ -0,0 +1,69 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [chat=%(chat_id)s game=%(game)s state=%(state)s] %(message)s"
+CONTEXT_FIELDS = ("chat_id", "game", "state")
+
+_listener = None
+
+
+def setup_logging(level=logging.DEBUG, stream=sys.stdout):
+    """ Sets up the "dudo" loggers once per process. Records are
+        put on a queue and written by a listener thread, so the
+        event loop never blocks on the stream.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(stream)
+    handler.setLevel(level)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(ContextDefaults())
+
+    log_queue = queue.Queue(-1)
+    logger = logging.getLogger("dudo")
+    logger.setLevel(level)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """ Flushes pending records and stops the listener thread. """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class ContextDefaults(logging.Filter):
+    """ Fills in the structured fields of records logged outside a game. """
+
+    def filter(self, record):
+        for field in CONTEXT_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, "-")
+        return True
+
+
+class GameLogger(logging.LoggerAdapter):
+    """ Adds the chat, game and current state of a game to its records. """
+
+    def __init__(self, logger, game):
+        super().__init__(logger, None)
+        self.game = game
+
+    def process(self, msg, kwargs):
+        state = getattr(self.game, "current_state", None)
+        kwargs["extra"] = {
+            "chat_id": self.game.chat_id,
+            "game": self.game.game_id,
+            "state": "-" if state is None else type(state).__name__,
+        }
+        return msg, kwargs
@@ -0,0 +1,232 @@
+""" Prometheus metrics for game and transport health, served in the
+    text exposition format on a small local HTTP endpoint, which also
+    switches tracing on and off (see tracing.py).
+
+    Whatever can be read off live objects (games per state, outbox
+    depth, timers) is only read when scraped. Whatever has to be
+    measured as it happens (latencies, waits, transitions) is only
+    measured while someone is scraping: the first scrape turns it on,
+    and it turns itself off once nobody has scraped for SCRAPE_IDLE
+    seconds. Until then the hot paths pay one attribute check.
+"""
+import asyncio
+import logging
+import weakref
+from bisect import bisect_left
+from collections import defaultdict
+
+from states import STATES
+from tracing import TRACER
+
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Measuring stops this long after the last scrape
+SCRAPE_IDLE = 300.0
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is for the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels=""):
+        separator = "," if labels else ""
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield '%s_bucket{%s%sle="%g"} %d' % (name, labels, separator, bound, total)
+        total += self.counts[-1]
+        yield '%s_bucket{%s%sle="+Inf"} %d' % (name, labels, separator, total)
+        labels = "{%s}" % labels if labels else ""
+        yield "%s_sum%s %r" % (name, labels, self.sum)
+        yield "%s_count%s %d" % (name, labels, total)
+
+
+class Metrics:
+    """ The process' metrics. Hot paths check enabled before measuring
+        anything; collectors are stats() functions of long-lived
+        objects, called on every scrape.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("dudo.metrics")
+        self.enabled = False
+        self.scrapes = 0
+        self.last_scrape = 0.0
+        self.idle_handle = None
+
+        # Every live game, counted per state when scraped
+        self.games = weakref.WeakSet()
+        self.collectors = dict()
+
+        self.transitions = defaultdict(int)
+        self.apply_seconds = defaultdict(Histogram)
+        self.announce_seconds = Histogram()
+        self.insult_seconds = Histogram()
+        self.mailbox_wait_seconds = Histogram(WAIT_BUCKETS)
+
+    def collect(self, prefix, stats, counters=()):
+        """ Exports every value of stats() as prefix_<key> on each
+            scrape: as a counter if the key is in counters, as a gauge
+            otherwise. Registering a prefix again replaces it.
+        """
+        self.collectors[prefix] = (stats, frozenset(counters))
+
+    def transition(self, old_state, new_state):
+        self.transitions[(old_state, new_state)] += 1
+
+    def scraped(self):
+        loop = asyncio.get_event_loop()
+        self.scrapes += 1
+        self.last_scrape = loop.time()
+        if not self.enabled:
+            self.logger.info("Scraped, measuring from now on")
+            self.enabled = True
+        if self.idle_handle is None:
+            self.idle_handle = loop.call_later(SCRAPE_IDLE, self.check_idle)
+
+    def check_idle(self):
+        loop = asyncio.get_event_loop()
+        idle = loop.time() - self.last_scrape
+        if idle < SCRAPE_IDLE:
+            self.idle_handle = loop.call_later(SCRAPE_IDLE - idle, self.check_idle)
+        else:
+            self.logger.info("Not scraped for %d seconds, measuring stopped", idle)
+            self.idle_handle = None
+            self.enabled = False
+
+    def render(self):
+        lines = []
+
+        per_state = dict.fromkeys(STATES, 0)
+        for game in list(self.games):
+            if not game.dead and game.current_state is not None:
+                per_state[type(game.current_state).__name__] += 1
+        lines.append("# HELP dudo_games Live games, by state.")
+        lines.append("# TYPE dudo_games gauge")
+        lines.extend('dudo_games{state="%s"} %d' % item for item in sorted(per_state.items()))
+
+        lines.append("# HELP dudo_state_transitions_total State changes of every game, since measuring began.")
+        lines.append("# TYPE dudo_state_transitions_total counter")
+        transitions = sorted(((type(old_state).__name__, type(new_state).__name__), count)
+                             for (old_state, new_state), count in self.transitions.items())
+        for (old_name, new_name), count in transitions:
+            lines.append('dudo_state_transitions_total{from="%s",to="%s"} %d' % (old_name, new_name, count))
+
+        lines.append("# HELP dudo_apply_seconds Time to apply what was posted to a game, by function.")
+        lines.append("# TYPE dudo_apply_seconds histogram")
+        for function, histogram in sorted(self.apply_seconds.items()):
+            lines.extend(histogram.lines("dudo_apply_seconds", 'function="%s"' % function))
+
+        for name, help_text, histogram in (
+                ("dudo_announce_seconds", "Time to flush a game's announcements.", self.announce_seconds),
+                ("dudo_insult_seconds", "Time to generate an insult.", self.insult_seconds),
+                ("dudo_mailbox_wait_seconds", "Time input waits in a game's mailbox before it's applied.",
+                 self.mailbox_wait_seconds)):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s histogram" % name)
+            lines.extend(histogram.lines(name))
+
+        for prefix, (stats, counters) in sorted(self.collectors.items()):
+            for key, value in sorted(stats().items()):
+                if key in counters:
+                    lines.append("# TYPE %s_%s_total counter" % (prefix, key))
+                    lines.append("%s_%s_total %r" % (prefix, key, value))
+                else:
+                    lines.append("# TYPE %s_%s gauge" % (prefix, key))
+                    lines.append("%s_%s %r" % (prefix, key, value))
+
+        lines.append("# TYPE dudo_metrics_scrapes_total counter")
+        lines.append("dudo_metrics_scrapes_total %d" % self.scrapes)
+        lines.append("")
+        return "\n".join(lines)
+
+
+METRICS = Metrics()
+
+
+class MetricsServer:
+    """ Answers GET /metrics with the rendered metrics, and the tracing
+        routes. It speaks just enough HTTP/1.0 for a scraper or curl,
+        one request per connection. The tracing routes change what the
+        process does, so keep it listening on a private address.
+    """
+
+    def __init__(self, metrics=METRICS, path=METRICS_PATH):
+        self.logger = logging.getLogger("dudo.metrics")
+        self.metrics = metrics
+        self.path = path
+        self.server = None
+
+        self.routes = TRACER.routes()
+        self.routes[path] = self.scrape
+
+    def scrape(self, query):
+        self.metrics.scraped()
+        return "200 OK", CONTENT_TYPE, self.metrics.render()
+
+    async def on_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Headers are of no use to us, but must be read
+            while (await reader.readline()).strip():
+                pass
+
+            parts = request_line.decode("latin-1").split()
+            path, _, query = parts[1].partition("?") if len(parts) >= 2 else ("", "", "")
+            route = self.routes.get(path)
+            if len(parts) < 2 or parts[0] not in ("GET", "HEAD"):
+                status, content_type, body = "405 Method Not Allowed", "text/plain", ""
+            elif route is None:
+                status, content_type, body = "404 Not Found", "text/plain", ""
+            else:
+                try:
+                    # Parameters are plain numbers, there is nothing to unquote
+                    status, content_type, body = route(dict(pair.partition("=")[::2]
+                                                            for pair in query.split("&") if pair))
+                except (KeyError, ValueError) as e:
+                    status, content_type, body = "400 Bad Request", "text/plain", "%s\n" % e
+
+            body = body.encode("utf8")
+            writer.write(("HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" %
+                          (status, content_type, len(body))).encode("latin-1"))
+            if parts and parts[0] != "HEAD":
+                writer.write(body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            self.logger.exception("Could not serve metrics")
+        finally:
+            writer.close()
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.on_connection, host, port)
+        self.logger.info("Serving metrics on %s:%s%s", host, port, self.path)
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+def start_metrics(listen, offset=0):
+    """ Serves metrics on listen's HOST:PORT, plus offset to the port. """
+    host, _, port = listen.rpartition(":")
+    server = MetricsServer()
+    asyncio.get_event_loop().run_until_complete(server.start(host, int(port) + offset))
+    return server
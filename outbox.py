@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telepot.exception import TelegramError
+
+# Telegram allows about 30 messages per second overall and 20 per minute in a group
+GLOBAL_RATE = 30.0
+CHAT_RATE = 20 / 60.0
+CHAT_BURST = 3
+
+MAX_RETRIES = 5
+LATENCY_WINDOW = 1000
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_to_full(self):
+        self.refill()
+        return (self.burst - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Outbox:
+    """ Central scheduler for outbound API calls. Calls are queued
+        per chat and sent in order by one worker per chat, within
+        per-chat and global rate budgets. Submitting never waits
+        for the network, so games don't hold their locks during I/O.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.logger = logging.getLogger("dudo.outbox")
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+
+        self.queues = dict()
+        self.workers = dict()
+        self.buckets = dict()
+
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def sender(self, bot, chat_id):
+        return ChatOutbox(self, bot, chat_id)
+
+    def submit(self, chat_id, method, *args, **kwargs):
+        """ Queues a call to the coroutine function method and
+            returns a future for its result.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+        queue.append((method, args, kwargs, future, time.monotonic()))
+        self.depth += 1
+
+        if chat_id not in self.workers:
+            self.workers[chat_id] = loop.create_task(self._drain(chat_id))
+
+        return future
+
+    async def _drain(self, chat_id):
+        queue = self.queues[chat_id]
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+
+        try:
+            while queue:
+                method, args, kwargs, future, enqueued = queue[0]
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+
+                try:
+                    result = await self._call(method, args, kwargs)
+                except Exception as e:
+                    self.failed += 1
+                    self.logger.warning("Sending to chat %s failed: %r", chat_id, e)
+                    if not future.done():
+                        future.set_exception(e)
+                        # Nobody is required to await the result
+                        future.exception()
+                else:
+                    self.sent += 1
+                    if not future.done():
+                        future.set_result(result)
+
+                queue.popleft()
+                self.depth -= 1
+                self.latencies.append(time.monotonic() - enqueued)
+        finally:
+            del self.workers[chat_id]
+            del self.queues[chat_id]
+            # Forget the chat's budget once it would be full again anyway
+            asyncio.get_event_loop().call_later(bucket.time_to_full(), self._forget, chat_id)
+
+    def _forget(self, chat_id):
+        if chat_id not in self.workers:
+            self.buckets.pop(chat_id, None)
+
+    async def _call(self, method, args, kwargs):
+        for attempt in range(MAX_RETRIES):
+            try:
+                return await method(*args, **kwargs)
+            except TelegramError as e:
+                if e.error_code != 429 or attempt == MAX_RETRIES - 1:
+                    raise
+
+                parameters = e.json.get("parameters", {}) if isinstance(e.json, dict) else {}
+                retry_after = parameters.get("retry_after") or 2 ** attempt
+                self.retries += 1
+                self.logger.info("Rate limited, retrying in %s seconds", retry_after)
+                await asyncio.sleep(retry_after)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "queue_depth": self.depth,
+            "chats": len(self.queues),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "latency_p99": latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+
+class ChatOutbox:
+    """ Stands in for a chat's Sender: calls are queued on the
+        outbox and return a future instead of the sent message.
+    """
+
+    def __init__(self, outbox, bot, chat_id):
+        self.outbox = outbox
+        self.bot = bot
+        self.chat_id = chat_id
+
+    async def sendMessage(self, *args, **kwargs):
+        return self.outbox.submit(self.chat_id, self.bot.sendMessage, self.chat_id, *args, **kwargs)
+
+    async def editMessageText(self, message_id, *args, **kwargs):
+        return self.outbox.submit(self.chat_id, self.bot.editMessageText, (self.chat_id, message_id), *args, **kwargs)
@@ -0,0 +1,195 @@
+""" Odds of a bet: how likely it is that at least, or exactly, so many
+    players answered "yes", given how often each of them says yes.
+
+    The number of yes answers is a sum of independent trials with a
+    different rate each, a Poisson binomial. Its whole distribution is
+    worked out at once, so one pass gives the odds of every bet from 0
+    to the number of players. Large rosters are done with numpy, from
+    a Fourier transform of the trials' joint characteristic function:
+    one vectorized product and one FFT. Below NUMPY_MIN_PLAYERS, or
+    without numpy, they are convolved in plain Python, trial by trial,
+    which is cheaper than numpy's overhead at those sizes.
+
+    Rates are learned from the answers of every finished round, and
+    odds are cached by the rates they were worked out from, rounded to
+    RATE_STEPS, so games of players who answer alike share them.
+"""
+import math
+from collections import namedtuple, OrderedDict
+
+# Rates are rounded to multiples of 1 / RATE_STEPS, as are the cache keys
+RATE_STEPS = 20
+# A player never seen answering says yes half of the time
+PRIOR_YES = 1
+PRIOR_ANSWERS = 2
+# Players whose rates are kept, least recently seen first out
+MAX_PLAYERS = 10000
+# Distributions kept, least recently used first out
+MAX_ODDS = 4096
+# Rosters from this size on are transformed with numpy, when it's there
+NUMPY_MIN_PLAYERS = 20
+
+
+class Odds(namedtuple("Odds", "exactly at_least")):
+    """ exactly[n] and at_least[n] are the chances of n players, out
+        of len(exactly) - 1, answering yes.
+    """
+    __slots__ = ()
+
+    @property
+    def players(self):
+        return len(self.exactly) - 1
+
+    def stands(self, bet):
+        """ Chance that bet is not too high. """
+        if bet > self.players:
+            return 0.0
+        return self.at_least[bet] if bet > 0 else 1.0
+
+    def doubt(self, bet):
+        """ Chance that doubting bet wins. """
+        return 1.0 - self.stands(bet)
+
+    def fit(self, bet):
+        """ Chance that fitting bet wins. """
+        return self.exactly[bet] if 0 <= bet <= self.players else 0.0
+
+
+_numpy = []
+
+
+def load_numpy():
+    """ numpy, or None without it. Imported on first use: it takes
+        longer to import than the whole bot, and most games never
+        get a roster large enough to need it.
+    """
+    if not _numpy:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy.append(numpy)
+    return _numpy[0]
+
+
+def convolve(rates):
+    """ Distribution of the number of successes, one trial at a time. """
+    counts = [1.0]
+    for rate in rates:
+        miss = 1.0 - rate
+        following = [count * miss for count in counts]
+        following.append(0.0)
+        for successes, count in enumerate(counts, 1):
+            following[successes] += count * rate
+        counts = following
+    return counts
+
+
+def transform(rates, numpy):
+    """ Distribution of the number of successes, from the discrete
+        Fourier transform of its characteristic function.
+    """
+    n = len(rates)
+    rates = numpy.asarray(rates, dtype=float)[:, None]
+    roots = numpy.exp(2j * math.pi * numpy.arange(n + 1) / (n + 1))
+    characteristic = (1.0 - rates + rates * roots).prod(axis=0)
+    counts = numpy.fft.fft(characteristic).real / (n + 1)
+    # Rounding leaves tiny negative chances where there should be none
+    return numpy.clip(counts, 0.0, 1.0).tolist()
+
+
+def distribution(rates):
+    if len(rates) >= NUMPY_MIN_PLAYERS:
+        numpy = load_numpy()
+        if numpy is not None:
+            return transform(rates, numpy)
+    return convolve(rates)
+
+
+def yes_rate(yes, answers):
+    return (yes + PRIOR_YES) / (answers + PRIOR_ANSWERS)
+
+
+def rate_step(rate):
+    # Never all the way to 0 or 1, no history is long enough to be sure
+    return min(max(round(rate * RATE_STEPS), 1), RATE_STEPS - 1)
+
+
+UNKNOWN_STEP = rate_step(yes_rate(0, 0))
+
+
+def at_least(exactly):
+    chances = [0.0] * len(exactly)
+    total = 0.0
+    for n in range(len(exactly) - 1, -1, -1):
+        total += exactly[n]
+        chances[n] = min(total, 1.0)
+    return chances
+
+
+class Engine:
+    """ Yes rates of every player seen answering, and the odds of the
+        rosters asked about. Both are bounded, least recently used
+        first out.
+    """
+
+    def __init__(self, max_players=MAX_PLAYERS, max_odds=MAX_ODDS):
+        self.max_players = max_players
+        self.max_odds = max_odds
+
+        # Player: [yes answers, answers, rounded rate]
+        self.answers = OrderedDict()
+        self.cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def learn(self, answers):
+        """ Counts the answers, by player, of a finished round. """
+        for player, answer in answers.items():
+            counts = self.answers.get(player)
+            if counts is None:
+                counts = self.answers[player] = [0, 0, 0]
+            else:
+                self.answers.move_to_end(player)
+            counts[0] += answer
+            counts[1] += 1
+            counts[2] = rate_step(yes_rate(counts[0], counts[1]))
+
+        while len(self.answers) > self.max_players:
+            self.answers.popitem(last=False)
+
+    def rate(self, player):
+        counts = self.answers.get(player)
+        return yes_rate(0, 0) if counts is None else yes_rate(counts[0], counts[1])
+
+    def step(self, player):
+        counts = self.answers.get(player)
+        return UNKNOWN_STEP if counts is None else counts[2]
+
+    def odds(self, players, known=()):
+        """ Odds of every count of yes answers, among players whose
+            answers are unknown and those in known, which are.
+        """
+        yes = sum(known)
+        key = (tuple(sorted(self.step(player) for player in players)), yes, len(known))
+
+        odds = self.cache.get(key)
+        if odds is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return odds
+
+        self.misses += 1
+        counts = distribution([step / RATE_STEPS for step in key[0]])
+        exactly = [0.0] * yes + counts + [0.0] * (len(known) - yes)
+        odds = self.cache[key] = Odds(tuple(exactly), tuple(at_least(exactly)))
+        if len(self.cache) > self.max_odds:
+            self.cache.popitem(last=False)
+        return odds
+
+    def stats(self):
+        return {"players": len(self.answers), "odds": len(self.cache), "hits": self.hits, "misses": self.misses}
+
+
+ENGINE = Engine()
@@ -0,0 +1,216 @@
+""" Deterministic replay of recorded game inputs.
+
+    A recording is a JSON lines file of journal events for one game,
+    {"kind": "action", "data": ["Join", 1, "Ana"]} or {"kind": "timeout"},
+    starting right after /startgame. Replaying drives a DudoStateMachine
+    through them with no network, no event loop and no real timers, with
+    seeded insults, and collects what it would have sent.
+
+    Usage:
+        python replay.py RECORDING [--seed N] [--write OUTPUT] [--expected OUTPUT]
+        python replay.py --bench N
+
+    With --trace PATH, either writes a Chrome trace of the replay to
+    PATH and its folded stacks next to it, see tracing.py.
+"""
+import argparse
+import difflib
+import json
+import random
+import sys
+import time
+
+from actions import Answer, Doubt, Fit, Flee, Join, MakeBet, MakeQuestion, action_from_record
+from statemachine import DudoStateMachine
+from tracing import TRACER
+
+REPLAY_CHAT = 0
+
+
+def run_sync(coroutine):
+    """ Runs a coroutine that never suspends, without an event loop. """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise RuntimeError("Replayed coroutine tried to wait on something")
+
+
+class FrozenTimer:
+    __slots__ = ("delay",)
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def cancel(self):
+        pass
+
+    def remaining(self):
+        return self.delay
+
+
+class FrozenWheel:
+    """ Arms timers that never fire: timeouts come from the recording. """
+
+    def schedule(self, delay, callback, *args):
+        return FrozenTimer(delay)
+
+
+class RecordingSender:
+    def __init__(self):
+        self.step = None
+        self.outputs = []
+
+    async def sendMessage(self, text, reply_markup=None):
+        self.outputs.append({"step": self.step, "text": text, "poll": reply_markup is not None})
+        return {"message_id": len(self.outputs)}
+
+    async def editMessageText(self, message_id, text):
+        self.outputs.append({"step": self.step, "text": text, "edit": message_id})
+
+
+class Replayer:
+    def __init__(self, seed=0, edit_in_place=False):
+        self.seed = seed
+        self.edit_in_place = edit_in_place
+
+    def run(self, events):
+        """ Replays (kind, data) events and returns the messages sent. """
+        sender = RecordingSender()
+        context = DudoStateMachine(sender, REPLAY_CHAT, wheel=FrozenWheel())
+        context.insult_rng = random.Random(self.seed)
+        context.edit_in_place = self.edit_in_place
+        context.start()
+
+        for step, (kind, data) in enumerate(events):
+            sender.step = step
+            try:
+                if kind == "action":
+                    context.on_input(action_from_record(data))
+                    run_sync(context.force_announce())
+                elif kind == "timeout" and not context.dead:
+                    run_sync(context.on_timeout())
+            except Exception as e:
+                # A live handler would log it and keep the game, so do we
+                sender.outputs.append({"step": step, "error": "%s: %s" % (type(e).__name__, e)})
+                context.announcement_buffer = []
+
+        context.destroy()
+        return sender.outputs
+
+
+def load_events(path):
+    with open(path, encoding="utf8") as events_file:
+        return [(event["kind"], event.get("data")) for event in map(json.loads, events_file) if event]
+
+
+def load_outputs(path):
+    with open(path, encoding="utf8") as outputs_file:
+        return [json.loads(line) for line in outputs_file if line.strip()]
+
+
+def diff_outputs(expected, actual):
+    """ Returns a unified diff of two output lists, empty if equal. """
+    return list(difflib.unified_diff([json.dumps(output, ensure_ascii=False) for output in expected],
+                                     [json.dumps(output, ensure_ascii=False) for output in actual],
+                                     "expected", "replayed", lineterm=""))
+
+
+def random_events(n, players=8, seed=0):
+    """ A random stream of inputs, mostly legal, for benchmarking. """
+    rng = random.Random(seed)
+    ids = list(range(1, players + 1))
+    events = [("action", Join(player, "Player %d" % player).to_record()) for player in ids]
+    events.append(("timeout", None))
+
+    makers = [
+        lambda player: MakeQuestion(player, "Question %d?" % rng.randint(0, 99), rng.randint(1, 3)),
+        lambda player: Answer(player, rng.randint(0, 1)),
+        lambda player: Answer(player, rng.randint(0, 1)),
+        lambda player: Answer(player, rng.randint(0, 1)),
+        lambda player: MakeBet(player, rng.randint(1, players + 1)),
+        lambda player: MakeBet(player, rng.randint(1, players + 1)),
+        lambda player: Doubt(player),
+        lambda player: Fit(player),
+    ]
+
+    while len(events) < n:
+        if rng.random() < 0.01:
+            events.append(("timeout", None))
+        elif rng.random() < 0.002:
+            events.append(("action", Flee(rng.choice(ids)).to_record()))
+        else:
+            events.append(("action", rng.choice(makers)(rng.choice(ids)).to_record()))
+
+    return events
+
+
+def bench(n, game_length=500):
+    recordings = [random_events(game_length, seed=seed) for seed in range(max(1, n // game_length))]
+    replayer = Replayer()
+
+    start = time.perf_counter()
+    outputs = [replayer.run(events) for events in recordings]
+    elapsed = time.perf_counter() - start
+
+    n_events = sum(len(events) for events in recordings)
+    same = [replayer.run(events) for events in recordings[:10]] == outputs[:10]
+    print("%d games, %d events, %d messages in %.2fs: %.0f actions per minute, deterministic: %s" %
+          (len(recordings), n_events, sum(map(len, outputs)), elapsed, n_events / elapsed * 60, same))
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog="replay.py", description="Replay a recorded game")
+    parser.add_argument("recording", nargs="?")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the insult grammar")
+    parser.add_argument("--edit-in-place", action="store_true")
+    parser.add_argument("--write", metavar="OUTPUT", help="write the replayed messages as JSON lines")
+    parser.add_argument("--expected", metavar="OUTPUT", help="diff the replayed messages against these")
+    parser.add_argument("--bench", type=int, metavar="N", help="replay N random events and report the rate")
+    parser.add_argument("--trace", metavar="PATH", help="write a Chrome trace and folded stacks of the replay")
+    parser.add_argument("--trace-sample", type=float, default=1.0, metavar="R", help="share of calls traced")
+    options = parser.parse_args(args)
+
+    if options.trace:
+        TRACER.start(options.trace_sample)
+        try:
+            return replay(parser, options)
+        finally:
+            TRACER.stop()
+            TRACER.write(options.trace)
+    return replay(parser, options)
+
+
+def replay(parser, options):
+    if options.bench:
+        bench(options.bench)
+        return 0
+
+    if options.recording is None:
+        parser.error("a recording is required")
+
+    outputs = Replayer(options.seed, options.edit_in_place).run(load_events(options.recording))
+
+    if options.write:
+        with open(options.write, "w", encoding="utf8") as outputs_file:
+            for output in outputs:
+                outputs_file.write(json.dumps(output, ensure_ascii=False) + "\n")
+
+    if options.expected:
+        diff = diff_outputs(load_outputs(options.expected), outputs)
+        for line in diff:
+            print(line)
+        return 1 if diff else 0
+
+    if not options.write:
+        for output in outputs:
+            print(json.dumps(output, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
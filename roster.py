@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+
+class Roster:
+    """ Ordered set of players with O(1) membership, removal,
+        current-turn lookup and rotation. It iterates in turn
+        order, which is join order until it is rotated.
+
+        A plain dict would take less memory, but rotating it leaves
+        a dummy entry at the front that every later lookup of the
+        current player has to skip, until the next resize. That makes
+        turns cost more the larger the chat; an OrderedDict's don't.
+    """
+    __slots__ = ("order",)
+
+    def __init__(self, players=()):
+        self.order = OrderedDict.fromkeys(players)
+
+    def add(self, player):
+        self.order[player] = None
+
+    def remove(self, player):
+        del self.order[player]
+
+    @property
+    def current(self):
+        """ The player whose turn it is, or None if empty. """
+        return next(iter(self.order), None)
+
+    def rotate(self):
+        """ Passes the turn on: the current player goes last. """
+        if self.order:
+            self.order.move_to_end(next(iter(self.order)))
+
+    def __contains__(self, player):
+        return player in self.order
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __repr__(self):
+        return "Roster(%r)" % list(self.order)
@@ -0,0 +1,514 @@
+""" Sharding of group chats across worker processes, one per core.
+
+    A front process reads updates, from Telegram or from a stand-in
+    source, and hands each one to the worker that owns its chat over
+    that worker's pipe. Chats are placed on a consistent hash ring, so
+    all the updates of a chat go to the same worker in the order they
+    arrived. Each worker runs its own bot, DudoHandlers, outbox (with
+    its share of the global rate), timing wheel and journal.
+
+    When a worker dies, the updates still in its pipe are taken back.
+    It is respawned with the same journal, which recovers its games;
+    if it keeps dying it's taken off the ring instead, and its chats
+    move to the other workers. Either way the updates taken back are
+    sent on, ahead of any newer ones. Once no worker is left, the front
+    stops.
+
+    Usage: python sharding.py --workers N --stand-in CHATS [--rate R] [--duration S] [--chaos S]
+"""
+import argparse
+import asyncio
+import bisect
+import collections
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import random
+import struct
+import sys
+import time
+
+import telepot.aio
+
+from catalogs import load_catalogs
+from handler import make_bot
+from hibernation import HIBERNATION_DIR, Hibernator
+from insults import get_insulter
+from journal import Journal
+from logconfig import setup_logging, stop_logging
+from metrics import start_metrics
+from outbox import GLOBAL_RATE, Outbox
+from stats import Stats
+from updates import chat_of, message_of
+
+VIRTUAL_NODES = 64
+
+# A worker dying more often than this is taken off the ring
+MAX_RESPAWNS = 3
+RESPAWN_WINDOW = 60.0
+
+# Seconds a stopping worker gives its games to flush what they have left
+STOP_GRACE = 1.0
+
+LONG_POLL = 20
+
+# Updates are framed as Connection.send_bytes does: their length, then their pickle
+FRAME_HEADER = struct.Struct("!i")
+
+
+def worker_journal(path, index):
+    """ Each worker has its own journal: dudo.db is dudo-0.db, dudo-1.db... """
+    root, extension = os.path.splitext(path)
+    return "%s-%d%s" % (root, index, extension)
+
+
+class HashRing:
+    """ Consistent hashing of chat ids to nodes. Each node owns many
+        points on the ring, so removing one only moves its own chats,
+        spread evenly over the others.
+    """
+
+    def __init__(self, nodes=(), replicas=VIRTUAL_NODES):
+        self.replicas = replicas
+        self.points = []
+        self.owners = dict()
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key):
+        # Python's hash() of a str changes between processes, this doesn't
+        return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "big")
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = self.hash("%s-%d" % (node, replica))
+            self.owners[point] = node
+            bisect.insort(self.points, point)
+
+    def remove(self, node):
+        self.points = [point for point in self.points if self.owners[point] != node]
+        self.owners = dict((point, self.owners[point]) for point in self.points)
+
+    def node_for(self, key):
+        index = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
+
+    def __len__(self):
+        return len(set(self.owners.values()))
+
+
+class StandInBot(telepot.aio.DelegatorBot):
+    """ Delegates like the real bot, but only counts what it would send. """
+
+    sent = 0
+
+    async def sendMessage(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return {"message_id": self.sent}
+
+    async def editMessageText(self, msg_identifier, text, **kwargs):
+        self.sent += 1
+
+
+class Worker:
+    """ Feeds the updates from the front to this process' bot. """
+
+    def __init__(self, index, connection, bot, check_order=False):
+        self.logger = logging.getLogger("dudo.sharding")
+        self.index = index
+        self.connection = connection
+        # The front's copy of this end shares the flag, but only reads it once the writer is closed
+        os.set_blocking(connection.fileno(), False)
+        self.bot = bot
+        self.stopped = asyncio.get_event_loop().create_future()
+
+        # What has arrived of the update being read, and its length once known
+        self.frame = bytearray()
+        self.frame_size = None
+
+        self.handled = 0
+        # Last update id of each chat, to check that none arrives out of order
+        self.last_updates = dict() if check_order else None
+        self.out_of_order = 0
+
+    def receive(self):
+        """ Reads whatever the pipe has, without waiting for the rest of
+            an update only partly written. No read goes past the end of
+            an update, so that if the worker dies, what it leaves in the
+            pipe starts with a whole one for the front to take back.
+        """
+        fd = self.connection.fileno()
+        try:
+            while True:
+                size = FRAME_HEADER.size if self.frame_size is None else self.frame_size
+                data = os.read(fd, size - len(self.frame))
+                if not data:
+                    # The front is gone
+                    self.stop()
+                    return
+                self.frame += data
+                if len(self.frame) < size:
+                    continue
+
+                if self.frame_size is None:
+                    self.frame_size, = FRAME_HEADER.unpack(self.frame)
+                    self.frame = bytearray()
+                    continue
+                update = pickle.loads(self.frame)
+                self.frame = bytearray()
+                self.frame_size = None
+                if update is None:
+                    self.stop()
+                    return
+                self.handle(update)
+        except BlockingIOError:
+            pass
+
+    def handle(self, update):
+        if self.last_updates is not None:
+            chat_id = chat_of(update)
+            if update["update_id"] <= self.last_updates.get(chat_id, -1):
+                self.out_of_order += 1
+                self.logger.warning("Update %d of chat %s arrived after %d",
+                                    update["update_id"], chat_id, self.last_updates[chat_id])
+            self.last_updates[chat_id] = update["update_id"]
+
+        self.handled += 1
+        self.bot.handle(message_of(update))
+
+    def stop(self):
+        loop = asyncio.get_event_loop()
+        loop.remove_reader(self.connection.fileno())
+        if not self.stopped.done():
+            loop.call_later(STOP_GRACE, self.stopped.set_result, None)
+
+
+def run_worker(index, connection, options):
+    """ Entry point of a worker process. """
+    setup_logging()
+    logger = logging.getLogger("dudo.sharding")
+
+    if not getattr(options, "lazy", False):
+        get_insulter().fill_pools()
+        load_catalogs()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # The global limit is per bot, so the workers share it
+    outbox = Outbox(global_rate=GLOBAL_RATE / options.workers)
+    journal = Journal(worker_journal(options.journal, index)) if options.journal else None
+    # Workers share the directory: a chat is only ever with one worker at a
+    # time, and the one it moves to when its worker is dropped finds it there
+    hibernator = Hibernator(options.hibernate_after, options.hibernate_dir) if options.hibernate_after else None
+    # Unlike journals, the stats of every worker go to the same store
+    stats = Stats(options.stats) if getattr(options, "stats", None) else None
+    bot = make_bot(options.token, outbox, journal, options.edit_in_place,
+                   StandInBot if options.stand_in else None, hibernator, stats)
+
+    if getattr(options, "metrics", None):
+        start_metrics(options.metrics, index)
+
+    worker = Worker(index, connection, bot, check_order=options.stand_in is not None)
+    loop.add_reader(connection.fileno(), worker.receive)
+    logger.info("Worker %d started", index)
+
+    try:
+        loop.run_until_complete(worker.stopped)
+        logger.info("Worker %d handled %d updates, %d out of order, and sent %d messages",
+                    index, worker.handled, worker.out_of_order, getattr(bot, "sent", 0))
+    finally:
+        if journal is not None:
+            journal.close()
+        if stats is not None:
+            stats.close()
+        # Worker processes exit without running atexit
+        stop_logging()
+
+
+class Shard:
+    __slots__ = ("process", "reader", "writer", "backlog", "partial", "partial_update", "waiting")
+
+    def __init__(self, process, reader, writer):
+        self.process = process
+        # The front keeps the reading end too, to take back what's left in it
+        self.reader = reader
+        self.writer = writer
+        self.backlog = collections.deque()
+        # What the pipe hasn't taken yet of the update being written
+        self.partial = b""
+        self.partial_update = None
+        # Whether the loop is waiting for the pipe to drain
+        self.waiting = False
+
+
+class Front:
+    """ Routes updates to the workers and replaces the ones that die.
+        Writes to a worker's pipe never block: updates wait in the
+        shard's backlog until the pipe takes them, and an update too
+        large to fit at once is written a piece at a time as it drains.
+    """
+
+    def __init__(self, options):
+        self.logger = logging.getLogger("dudo.sharding")
+        self.options = options
+        self.processes = multiprocessing.get_context("spawn")
+        self.ring = HashRing()
+        self.shards = dict()
+        self.deaths = collections.defaultdict(collections.deque)
+        # Fails once there's no worker left to route to, for whoever runs the front
+        self.failed = asyncio.get_event_loop().create_future()
+
+        self.routed = 0
+        self.taken_back = 0
+        self.lost = 0
+
+    def start(self):
+        for index in range(self.options.workers):
+            self.spawn(index)
+            self.ring.add(index)
+
+    def spawn(self, index):
+        reader, writer = self.processes.Pipe(duplex=False)
+        process = self.processes.Process(target=run_worker, args=(index, reader, self.options),
+                                         name="dudo-worker-%d" % index, daemon=True)
+        process.start()
+        os.set_blocking(writer.fileno(), False)
+
+        self.shards[index] = Shard(process, reader, writer)
+        asyncio.get_event_loop().add_reader(process.sentinel, self.on_death, index)
+
+    def dispatch(self, update):
+        chat_id = chat_of(update)
+        if chat_id is None or self.failed.done():
+            return
+
+        self.routed += 1
+        self.send(self.ring.node_for(chat_id), update)
+
+    def send(self, index, update):
+        shard = self.shards[index]
+        shard.backlog.append(update)
+        if not shard.waiting:
+            self.flush(index)
+
+    def flush(self, index):
+        """ Writes as much of the backlog as the pipe takes, and has the
+            loop call again once it drains if that wasn't all of it.
+        """
+        shard = self.shards[index]
+        fd = shard.writer.fileno()
+        try:
+            while shard.partial or shard.backlog:
+                if not shard.partial:
+                    shard.partial_update = shard.backlog.popleft()
+                    data = pickle.dumps(shard.partial_update, pickle.HIGHEST_PROTOCOL)
+                    shard.partial = memoryview(FRAME_HEADER.pack(len(data)) + data)
+                # Up to PIPE_BUF bytes go whole or not at all, larger ones in pieces
+                shard.partial = shard.partial[os.write(fd, shard.partial):]
+        except BlockingIOError:
+            pass
+        if not shard.partial:
+            shard.partial_update = None
+
+        loop = asyncio.get_event_loop()
+        if shard.partial or shard.backlog:
+            if not shard.waiting:
+                loop.add_writer(fd, self.flush, index)
+                shard.waiting = True
+        elif shard.waiting:
+            loop.remove_writer(fd)
+            shard.waiting = False
+
+    def on_death(self, index):
+        loop = asyncio.get_event_loop()
+        shard = self.shards.pop(index)
+        loop.remove_reader(shard.process.sentinel)
+        if shard.waiting:
+            loop.remove_writer(shard.writer.fileno())
+        shard.process.join()
+
+        updates = self.take_back(shard)
+        self.logger.warning("Worker %d died with exit code %s, taking back %d updates",
+                            index, shard.process.exitcode, len(updates))
+
+        now = time.monotonic()
+        deaths = self.deaths[index]
+        deaths.append(now)
+        while deaths[0] < now - RESPAWN_WINDOW:
+            deaths.popleft()
+
+        if len(deaths) <= MAX_RESPAWNS:
+            self.spawn(index)
+        else:
+            self.logger.error("Worker %d keeps dying, moving its chats to the others", index)
+            self.ring.remove(index)
+            if not len(self.ring):
+                # Raising here would only be logged by the loop, which would go on routing to nobody
+                self.logger.critical("Every worker died, dropping %d updates", len(updates))
+                self.failed.set_exception(RuntimeError("Every worker died"))
+                return
+
+        # They are older than anything still to come for their chats
+        for update in updates:
+            self.dispatch(update)
+        self.routed -= len(updates)
+
+    def take_back(self, shard):
+        # With the writing end closed, an update cut short ends in an
+        # error instead of waiting forever for the rest of it
+        shard.writer.close()
+        updates = []
+        try:
+            while shard.reader.poll():
+                updates.append(shard.reader.recv())
+        except EOFError:
+            pass
+        except Exception:
+            # Unless we were still writing it, the worker died halfway
+            # through reading one, and the rest can't be framed
+            if not shard.partial:
+                self.lost += 1
+                self.logger.exception("Lost the updates left for a worker")
+        shard.reader.close()
+
+        if shard.partial:
+            # Not all of it reached the worker, so it can't have been handled
+            updates.append(shard.partial_update)
+        self.taken_back += len(updates) + len(shard.backlog)
+        return updates + list(shard.backlog)
+
+    async def run(self, updates):
+        """ Routes updates until they run out, or until every worker died,
+            which raises RuntimeError.
+        """
+        self.start()
+        feeding = asyncio.ensure_future(self.feed(updates))
+        await asyncio.wait((feeding, self.failed), return_when=asyncio.FIRST_COMPLETED)
+        if self.failed.done():
+            feeding.cancel()
+            self.failed.result()
+        feeding.result()
+        await self.stop()
+
+    async def feed(self, updates):
+        async for update in updates:
+            self.dispatch(update)
+
+    async def stop(self):
+        loop = asyncio.get_event_loop()
+        for index, shard in list(self.shards.items()):
+            loop.remove_reader(shard.process.sentinel)
+            # After whatever is still waiting for the pipe
+            self.send(index, None)
+
+        for shard in self.shards.values():
+            await loop.run_in_executor(None, shard.process.join)
+
+        self.logger.info("Routed %d updates, took back %d from dead workers", self.routed, self.taken_back)
+
+
+async def telegram_updates(bot, timeout=LONG_POLL):
+    """ Long-polls Telegram for updates, forever. """
+    logger = logging.getLogger("dudo.sharding")
+    offset = None
+    while True:
+        try:
+            updates = await bot.getUpdates(offset=offset, timeout=timeout)
+        except Exception:
+            logger.exception("Could not get updates")
+            await asyncio.sleep(1)
+            continue
+
+        for update in updates:
+            offset = update["update_id"] + 1
+            yield update
+
+
+def random_update(rng, update_id, chats, players=5):
+    """ One update of random but plausible group chat traffic: games
+        being started, joined, asked, voted and bet on, among chatter.
+    """
+    chat = {"id": -rng.randint(1, chats), "type": "group"}
+    user = {"id": rng.randint(1, players)}
+    user["first_name"] = "Player %d" % user["id"]
+
+    if rng.random() < 0.2:
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "data": rng.choice(("yes", "no")),
+            "message": {"message_id": 1, "chat": chat}}}
+
+    text = rng.choice(("/startgame", "/join", "/join", "/ask Is it red? ## 2", "/raise %d" % rng.randint(1, 6),
+                       "/dudo", "/calzo", "/flee", "jajaja", "who's in?", "ok"))
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "from": user, "chat": chat, "date": 0, "text": text}}
+
+
+async def stand_in_updates(chats, rate, duration, seed=0, players=5):
+    """ random_update traffic at about rate updates per second. """
+    rng = random.Random(seed)
+    update_id = 0
+    deadline = time.monotonic() + duration
+    batch = max(1, int(rate / 100))
+
+    while time.monotonic() < deadline:
+        for _ in range(batch):
+            update_id += 1
+            yield random_update(rng, update_id, chats, players)
+        await asyncio.sleep(batch / rate)
+
+
+async def chaos(front, interval, seed=0):
+    """ Kills a random worker every interval seconds, to see it replaced. """
+    rng = random.Random(seed)
+    while True:
+        await asyncio.sleep(interval)
+        if front.shards:
+            shard = front.shards[rng.choice(list(front.shards))]
+            shard.process.kill()
+
+
+def serve(options, updates):
+    """ Runs the front until updates runs out. options needs workers,
+        token, journal, edit_in_place, hibernate_after, hibernate_dir,
+        and stand_in (None for Telegram); metrics, lazy and stats are optional.
+    """
+    front = Front(options)
+    loop = asyncio.get_event_loop()
+    if getattr(options, "chaos", None):
+        loop.create_task(chaos(front, options.chaos))
+    loop.run_until_complete(front.run(updates))
+    return front
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog="sharding.py", description="Run workers on stand-in updates")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--stand-in", type=int, default=1000, metavar="CHATS", help="chats sending updates")
+    parser.add_argument("--rate", type=float, default=2000, help="updates per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to send updates for")
+    parser.add_argument("--chaos", type=float, metavar="S", help="kill a random worker every S seconds")
+    parser.add_argument("--journal", default="", metavar="PATH", help="base path of the workers' journals")
+    parser.add_argument("--edit-in-place", action="store_true")
+    parser.add_argument("--hibernate-after", type=float, metavar="SECONDS")
+    parser.add_argument("--hibernate-dir", default=HIBERNATION_DIR, metavar="PATH")
+    parser.add_argument("--metrics", metavar="HOST:PORT", help="worker N serves metrics on PORT+N")
+    parser.add_argument("--lazy", action="store_true", help="build grammars and translations on first use")
+    parser.add_argument("--stats", default="", metavar="PATH", help="player statistics store shared by the workers")
+    options = parser.parse_args(args)
+    options.token = ""
+
+    setup_logging(logging.INFO)
+    front = serve(options, stand_in_updates(options.stand_in, options.rate, options.duration))
+    print("routed %d updates to %d workers, took back %d from dead ones" %
+          (front.routed, options.workers, front.taken_back))
+
+
+if __name__ == "__main__":
+    main()
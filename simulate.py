@@ -0,0 +1,201 @@
+""" Headless load simulation: thousands of concurrent games in one
+    event loop, with scripted players and a fake sender.
+
+    Players join, ask, vote, raise, doubt, fit, flee or go idle at
+    random, often several at once, so that games apply bursts of
+    inputs in one batch. Game time is scaled down so timeouts happen
+    in seconds.
+    Reports throughput, latency from posting an input to the end of
+    the flush that announced it, timer counts and memory per game.
+
+    Usage: python simulate.py [--games N] [--duration S] [--scale F] ...
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from array import array
+
+import footprint
+from actor import GameActor
+from actions import Answer, Doubt, Fit, Flee, Join, MakeBet, MakeQuestion
+from states import State
+from statemachine import DudoStateMachine
+from timers import TimingWheel
+
+
+class FakeSender:
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.last_message = None
+
+    async def sendMessage(self, text, **kwargs):
+        self.simulation.messages += 1
+        self.last_message = text
+        return {"message_id": self.simulation.messages}
+
+    async def editMessageText(self, message_id, text, **kwargs):
+        self.simulation.messages += 1
+        self.last_message = text
+
+
+class Simulation:
+    def __init__(self, games, players, think_time, idle_rate, flee_rate, scale, seed, burst=1):
+        self.n_games = games
+        self.n_players = players
+        self.think_time = think_time
+        self.burst = burst
+        self.idle_rate = idle_rate
+        self.flee_rate = flee_rate
+        self.rng = random.Random(seed)
+        self.wheel = TimingWheel(tick=0.01, scale=scale)
+
+        self.stopping = False
+        self.actions = 0
+        self.messages = 0
+        self.errors = 0
+        self.games_played = 0
+        self.latencies = array("d")
+        self.peak_tasks = 0
+
+    def new_game(self, chat_id):
+        return DudoStateMachine(FakeSender(self), chat_id, wheel=self.wheel)
+
+    def checked_input(self, context, action):
+        try:
+            context.on_input(action)
+        except Exception:
+            # The actor would only get it logged
+            self.errors += 1
+            context.announcement_buffer = []
+
+    async def apply(self, context, actions):
+        """ Posts actions together, and waits until they are applied and announced. """
+        start = time.perf_counter()
+        for action in actions:
+            context.actor.post(self.checked_input, context, action)
+        await context.actor.drained()
+        latency = time.perf_counter() - start
+        for _ in actions:
+            self.latencies.append(latency)
+        self.actions += len(actions)
+
+    def choose(self, context, players, seats):
+        """ Picks the next action of some player, or None to idle. """
+        rng = self.rng
+        state = context.current_state
+
+        if state is State.waiting_for_players:
+            joined = len(context.players)
+            return Join(seats[joined], "Player %d" % seats[joined]) if joined < len(seats) else None
+
+        if rng.random() < self.idle_rate:
+            return None
+        if rng.random() < self.flee_rate:
+            return Flee(rng.choice(players))
+
+        if state is State.waiting_for_question:
+            return MakeQuestion(context.questioners.current, "Question?", rng.randint(1, len(players)))
+        if state is State.waiting_for_answers:
+            return Answer(rng.choice(players), rng.randint(0, 1))
+        if state is State.waiting_for_guess:
+            guesser = context.guessers.current
+            choice = rng.random()
+            if context.previous_guesser is not None and choice < 0.3:
+                return Doubt(guesser)
+            if context.previous_guesser is not None and choice < 0.4:
+                return Fit(guesser)
+            # Sometimes too low or too high, on purpose
+            return MakeBet(guesser, rng.randint(context.current_bet, context.current_bet + 2))
+        return None
+
+    async def play(self, index):
+        """ Plays games in one chat, one after another, until stopped. """
+        chat_id = -index - 1
+        seats = [index * 1000 + seat for seat in range(self.n_players)]
+
+        while not self.stopping:
+            context = self.new_game(chat_id)
+            context.announce_start("Player %d" % seats[0])
+            context.start()
+            await self.apply(context, [Join(seats[0], "Player %d" % seats[0])])
+
+            while not context.dead and not self.stopping:
+                await asyncio.sleep(self.rng.expovariate(1.0 / self.think_time))
+                players = list(context.players)
+                if not players:
+                    break
+                # Up to burst players act before the game has applied any of it
+                actions = [self.choose(context, players, seats) for _ in range(self.rng.randint(1, self.burst))]
+                actions = [action for action in actions if action is not None]
+                if actions:
+                    await self.apply(context, actions)
+
+            context.destroy()
+            self.games_played += 1
+
+    async def monitor(self):
+        while not self.stopping:
+            self.peak_tasks = max(self.peak_tasks, len(asyncio.all_tasks()))
+            await asyncio.sleep(0.1)
+
+    async def run(self, duration):
+        players = [asyncio.ensure_future(self.play(index)) for index in range(self.n_games)]
+        monitor = asyncio.ensure_future(self.monitor())
+
+        start = time.perf_counter()
+        await asyncio.sleep(duration)
+        self.stopping = True
+        await asyncio.gather(monitor, *players)
+        return time.perf_counter() - start
+
+    def measure_memory(self, n=1000):
+        """ Bytes per idle game and per active game, see footprint.py. """
+        return footprint.measure(self.new_game, n, self.n_players)
+
+    def report(self, elapsed, memory):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+
+        wheel = self.wheel.stats()
+        actors = GameActor.stats()
+        print("games:            %d concurrent, %d played" % (self.n_games, self.games_played))
+        print("throughput:       %d actions in %.1fs = %.0f actions/s, %d messages" %
+              (self.actions, elapsed, self.actions / elapsed, self.messages))
+        print("errors:           %d actions raised" % self.errors)
+        print("latency:          p50 %.3f ms, p99 %.3f ms" % (percentile(0.5), percentile(0.99)))
+        print("timers:           %d armed, %d cancelled, %d fired" %
+              (wheel["armed"], wheel["cancelled"], wheel["fired"]))
+        print("batches:          %d inputs in %d flushes" % (actors["inputs"], actors["batches"]))
+        print("tasks:            peak %d (%d of them scripted players)" % (self.peak_tasks, self.n_games))
+        print("memory per game:  %.0f bytes idle, %.0f bytes active" % tuple(memory))
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog="simulate.py", description="Simulate many concurrent games")
+    parser.add_argument("--games", type=int, default=1000, help="concurrent games")
+    parser.add_argument("--players", type=int, default=5, help="players per game")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--think-time", type=float, default=0.05, help="mean seconds between actions in a game")
+    parser.add_argument("--idle-rate", type=float, default=0.05, help="chance a player lets their turn pass")
+    parser.add_argument("--flee-rate", type=float, default=0.005, help="chance a player flees")
+    parser.add_argument("--scale", type=float, default=0.01, help="game seconds per real second")
+    parser.add_argument("--burst", type=int, default=4, help="most inputs a game gets at once")
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args(args)
+
+    simulation = Simulation(options.games, options.players, options.think_time, options.idle_rate,
+                            options.flee_rate, options.scale, options.seed, options.burst)
+    memory = simulation.measure_memory()
+    elapsed = asyncio.get_event_loop().run_until_complete(simulation.run(options.duration))
+    simulation.report(elapsed, memory)
+
+
+if __name__ == "__main__":
+    main()
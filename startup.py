@@ -0,0 +1,150 @@
+""" Startup time report: how long the bot takes from being launched to
+    handling its first update, built eagerly and with --lazy, and which
+    modules the imports spend that time in.
+
+    Every run is a fresh interpreter, started with -X importtime, that
+    builds the bot as __main__ does, with a stand-in for Telegram, and
+    hands it a /startgame at once. The time to first update runs from
+    launching the interpreter to the first message the bot sends.
+
+    Usage: python startup.py [--runs N] [--top N]
+"""
+import time
+
+# Before anything else is imported, to count everything the bot imports
+STARTED = time.monotonic()
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODES = ("eager", "lazy")
+START_GAME = {"message_id": 1, "from": {"id": 1, "first_name": "Ana"},
+              "chat": {"id": -1, "type": "group"}, "date": 0, "text": "/startgame"}
+
+
+def first_update(lazy):
+    """ Runs in the child: builds the bot and waits for its answer to a
+        /startgame. Returns monotonic timestamps of each step.
+    """
+    times = {"started": STARTED}
+    spec = importlib.util.spec_from_file_location("dudo_main", os.path.join(HERE, "__main__.py"))
+    dudo_main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(dudo_main)
+
+    import telepot.aio
+    from logconfig import setup_logging
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    answered = loop.create_future()
+
+    class FirstUpdateBot(telepot.aio.DelegatorBot):
+        async def sendMessage(self, chat_id, text, **kwargs):
+            if not answered.done():
+                answered.set_result(time.monotonic())
+            return {"message_id": 1}
+
+        async def editMessageText(self, msg_identifier, text, **kwargs):
+            pass
+
+    times["imported"] = time.monotonic()
+    journal_path = os.path.join(os.environ.get("TMPDIR", "/tmp"), "dudo-startup-%d.db" % os.getpid())
+    try:
+        # As main does, but the log goes where the report won't read it
+        setup_logging(stream=sys.stderr)
+        options = dudo_main.parse_args(["--journal", journal_path, "--stats", ""] + (["--lazy"] if lazy else []))
+        bot, journal, _ = dudo_main.prepare(options, FirstUpdateBot)
+        times["ready"] = time.monotonic()
+
+        bot.handle(START_GAME)
+        times["answered"] = loop.run_until_complete(asyncio.wait_for(answered, 10))
+        journal.close()
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(journal_path + suffix):
+                os.remove(journal_path + suffix)
+    return times
+
+
+def import_times(stderr):
+    """ Self time in seconds of each top level package, from -X importtime. """
+    times = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        times[name.strip().split(".")[0]] += int(self_us) / 1e6
+    return times
+
+
+def run(mode):
+    # Only the parent needs it, and whatever the child imports is measured
+    import subprocess
+
+    launched = time.monotonic()
+    child = subprocess.run([sys.executable, "-X", "importtime", __file__, "--child", mode],
+                           cwd=HERE, capture_output=True, text=True, check=True)
+    times = json.loads(child.stdout.strip().splitlines()[-1])
+    phases = {
+        "interpreter": times["started"] - launched,
+        "imports": times["imported"] - times["started"],
+        "build bot": times["ready"] - times["imported"],
+        "first update": times["answered"] - times["ready"],
+        "total": times["answered"] - launched,
+    }
+    return phases, import_times(child.stderr)
+
+
+def report(runs, top):
+    from statistics import median
+
+    phases = dict((mode, defaultdict(list)) for mode in MODES)
+    imports = dict((mode, defaultdict(list)) for mode in MODES)
+    for _ in range(runs):
+        # Interleaved, so that both see the same machine
+        for mode in MODES:
+            run_phases, run_imports = run(mode)
+            for name, seconds in run_phases.items():
+                phases[mode][name].append(seconds)
+            for name, seconds in run_imports.items():
+                imports[mode][name].append(seconds)
+
+    def ms(values):
+        return median(values) * 1000 if values else 0.0
+
+    print("median of %d runs, ms     %10s %10s" % ((runs,) + MODES))
+    for name in phases["eager"]:
+        print("%-26s %10.1f %10.1f" % (name, ms(phases["eager"][name]), ms(phases["lazy"][name])))
+
+    print("\nimport self time by package, ms")
+    packages = sorted(set(imports["eager"]) | set(imports["lazy"]), key=lambda name: -ms(imports["eager"][name]))
+    for name in packages[:top]:
+        print("%-26s %10.1f %10.1f" % (name, ms(imports["eager"][name]), ms(imports["lazy"][name])))
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog="startup.py", description="Report where startup time goes")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="packages listed by import time")
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+
+    if options.child:
+        print(json.dumps(first_update(options.child == "lazy")))
+        return 0
+
+    report(options.runs, options.top)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,43 +1,54 @@
-import asyncio
-import concurrent
 import logging
-import sys
 
+from actions import Answer, action_from_record
+from actor import GameActor
+from ai import AI_DELAY, ai_name, guess, is_ai, new_ai_player, vote
 from announcer import Announcer
-from states import State
+from metrics import METRICS
+from probability import ENGINE
+from roster import Roster
+from states import State, STATES
+from timers import get_wheel
 
 MIN_PLAYERS = 2
 FINAL_GUESS_DOUBT = "doubt"
 FINAL_GUESS_FIT = "fit"
 
 
+def counted(player):
+    """ The player, as stats know them: None for AI players, who aren't counted. """
+    return None if is_ai(player) else player
+
+
 class DudoStateMachine(Announcer):
-    def __init__(self, sender):
-        Announcer.__init__(self, sender)
-        self.logger = logging.getLogger("dudo.statemachine")
-        self.logger.setLevel(logging.DEBUG)
-        self.handler = logging.StreamHandler(sys.stdout)
-        self.handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.handler.setFormatter(formatter)
-        self.logger.addHandler(self.handler)
-
-        self.angery_level = 0
-
-        self.loop = asyncio.get_event_loop()
-        self.timeout_task = None
-        self.timeout_lock = asyncio.Lock()
+    __slots__ = ("actor", "wheel", "timeout_timer", "answers", "yes_count", "pending_voters",
+                 "players", "player_names", "previous_guesser", "current_state", "current_question",
+                 "questioners", "guessers", "current_bet", "final_guess", "final_player", "game_owner",
+                 "dead", "journal", "journal_seq", "stats", "rates", "ai_players", "ai_timer", "__weakref__")
+
+    base_logger = logging.getLogger("dudo.statemachine")
+
+    def __init__(self, sender, chat_id=None, wheel=None):
+        Announcer.__init__(self, sender, chat_id)
 
+        self.actor = GameActor(self)
+        self.wheel = get_wheel() if wheel is None else wheel
+        self.timeout_timer = None
+
+        # Votes of the current round, tallied as they come in
         self.answers = dict()
-        self.players = list()
+        self.yes_count = 0
+        self.pending_voters = Roster()
+
+        self.players = Roster()
         self.player_names = dict()
 
         self.previous_guesser = None
         self.current_state = None
         self.current_question = None
 
-        self.questioners = list()
-        self.guessers = list()
+        self.questioners = Roster()
+        self.guessers = Roster()
 
         self.current_bet = 0
 
@@ -45,9 +56,20 @@ class DudoStateMachine(Announcer):
         self.final_player = None
 
         self.game_owner = None
-        self.timer = None
         self.dead = False
 
+        self.journal = None
+        self.journal_seq = 0
+        self.stats = None
+        # Where the answers of finished rounds are learned, if anywhere
+        self.rates = None
+
+        # How many of the players are AI players, which move on their own timer
+        self.ai_players = 0
+        self.ai_timer = None
+
+        METRICS.games.add(self)
+
     def announce_players(self, names=None):
         if names is None:
             names = ", ".join([self.player_names[p] for p in self.players])
@@ -67,19 +89,28 @@ class DudoStateMachine(Announcer):
 
     def on_input(self, new_input):
         if not self.dead:
-            self.logger.debug("Input %s" % new_input.action)
+            self.logger.debug("Input %s", new_input.action)
+            if self.journal is not None:
+                self.journal.record(self, "action", new_input.to_record())
             new_input.apply(self, self.current_state)
 
     def go_to(self, state):
+        if METRICS.enabled:
+            METRICS.transition(self.current_state, state)
         self.current_state = state
         self.current_state.run(self)
+        if self.ai_players:
+            self.schedule_ai()
 
     def add_player(self, player, name):
         if player not in self.players:
             self.player_names[player] = name
-            self.players.append(player)
-            self.questioners.append(player)
-            self.guessers.append(player)
+            self.players.add(player)
+            self.guessers.add(player)
+            if is_ai(player):
+                self.ai_players += 1
+            else:
+                self.questioners.add(player)
             self.announce_join(name)
 
             if len(self.players) == 1:
@@ -94,22 +125,39 @@ class DudoStateMachine(Announcer):
 
         self.players.remove(player)
         self.guessers.remove(player)
-        self.questioners.remove(player)
+        if is_ai(player):
+            self.ai_players -= 1
+        else:
+            self.questioners.remove(player)
+
+        # Whoever leaves takes their vote with them
+        if player in self.pending_voters:
+            self.pending_voters.remove(player)
+        self.yes_count -= self.answers.pop(player, 0)
 
         return True
 
+    def add_ai_player(self):
+        player = new_ai_player(self.players)
+        if player is None:
+            self.announce_too_many_ai_players()
+        else:
+            self.add_player(player, ai_name(player))
+
     def announce_questioner(self, name=None):
         if name is None:
-            name = self.player_names[self.guessers[0]]
+            # AI players never ask
+            player = self.guessers.current
+            name = self.player_names[self.questioners.current if is_ai(player) else player]
         super().announce_questioner(name)
 
     def choose_next_questioner(self):
         assert len(self.players) > 0
-        self.questioners.append(self.questioners.pop(0))
+        self.questioners.rotate()
 
     def announce_guesser(self, name=None, question=None, bet=None):
         if name is None:
-            name = self.player_names[self.guessers[0]]
+            name = self.player_names[self.guessers.current]
 
         if question is None:
             question = self.current_question
@@ -122,17 +170,21 @@ class DudoStateMachine(Announcer):
     def choose_next_guesser(self):
         assert len(self.players) > 0
 
-        self.previous_guesser = self.questioners[0] if self.previous_guesser is None else self.guessers[0]
-        self.guessers.append(self.guessers.pop(0))
+        self.previous_guesser = self.questioners.current if self.previous_guesser is None else self.guessers.current
+        self.guessers.rotate()
 
     def add_answer(self, player, answer):
         if player not in self.players:
             return
 
+        self.yes_count += answer - self.answers.get(player, 0)
         self.answers[player] = answer
+        if player in self.pending_voters:
+            self.pending_voters.remove(player)
 
     def check_game_over(self, min_players=MIN_PLAYERS):
-        if len(self.players) < min_players:
+        # AI players don't play on their own
+        if len(self.players) < min_players or len(self.players) == self.ai_players:
             self.announce_end_game_too_few_players()
             self.destroy()
             return True
@@ -155,10 +207,12 @@ class DudoStateMachine(Announcer):
 
     def clear(self):
         self.answers = dict()
-        self.players = list()
+        self.yes_count = 0
+        self.pending_voters = Roster()
+        self.players = Roster()
         self.current_question = None
-        self.questioners = list()
-        self.guessers = None
+        self.questioners = Roster()
+        self.guessers = Roster()
         self.previous_guesser = None
         self.current_bet = 0
         self.final_guess = None
@@ -171,7 +225,7 @@ class DudoStateMachine(Announcer):
         else:
             return
 
-        correct_number = sum(self.answers.values())
+        correct_number = self.yes_count
 
         if self.final_guess == FINAL_GUESS_FIT:
             final_player_won = self.current_bet == correct_number
@@ -180,56 +234,199 @@ class DudoStateMachine(Announcer):
         else:
             return
 
-        winner, loser = (self.player_names[self.final_player], self.player_names[self.previous_guesser]) \
-            if final_player_won else (self.player_names[self.previous_guesser], self.player_names[self.final_player])
+        winner_id, loser_id = (self.final_player, self.previous_guesser) \
+            if final_player_won else (self.previous_guesser, self.final_player)
+        winner, loser = self.player_names[winner_id], self.player_names[loser_id]
+
+        if self.rates is not None:
+            self.rates.learn(self.answers)
+
+        if self.stats is not None:
+            # AI players are the same few in every chat, their stats would mean nothing
+            self.stats.record_round(counted(winner_id), winner, counted(loser_id), loser,
+                                    counted(self.final_player), self.final_guess == FINAL_GUESS_DOUBT)
 
         self.announce_round_finished(winner,
                                      loser,
                                      ", ".join((self.player_names[player_id] for player_id in
                                                 (player_id for player_id in self.players
-                                                 if self.answers[player_id] == 1))))
+                                                 if self.answers.get(player_id) == 1))))
 
     def make_poll(self, player, question, initial_bet):
 
         self.current_bet = initial_bet
         self.current_question = question
 
+        self.answers = dict()
+        self.yes_count = 0
+        self.pending_voters = Roster(self.players)
+
         self.save_poll(player, question, initial_bet)
 
     def set_timeout(self, time):
-        if self.timeout_task is not None:
-            self.cancel_timeout()
+        self.cancel_timeout()
+        self.timeout_timer = self.wheel.schedule(time, self.fire_timeout)
+
+    def fire_timeout(self):
+        self.actor.post(self.expire_timeout, self.timeout_timer)
 
-        async def f():
-            try:
-                await asyncio.sleep(time)
-                with await self.timeout_lock:
-                    self.timeout_task = None
-                    await self.on_timeout()
-            except asyncio.CancelledError:
-                pass
+    def expire_timeout(self, timer):
+        # The timeout may have been re-armed or cancelled while in the mailbox
+        if timer is not self.timeout_timer or self.dead:
+            return
+        self.timeout_timer = None
+        self.apply_timeout()
 
-        self.timeout_task = self.loop.create_task(f())
+    def apply_timeout(self):
+        if self.journal is not None:
+            self.journal.record(self, "timeout", None)
+        self.current_state.on_timeout(self)
 
     async def on_timeout(self):
-        self.current_state.on_timeout(self)
+        self.apply_timeout()
         await self.force_announce()
 
     def cancel_timeout(self):
-        if self.timeout_task is not None:
-            self.timeout_task.cancel()
-            self.timeout_task = None
+        if self.timeout_timer is not None:
+            self.timeout_timer.cancel()
+            self.timeout_timer = None
+
+    def schedule_ai(self):
+        """ Has an AI player move in a while, if it's the turn of one. """
+        if self.current_state is State.waiting_for_answers:
+            waiting = any(is_ai(player) for player in self.pending_voters)
+        else:
+            waiting = self.current_state is State.waiting_for_guess and is_ai(self.guessers.current)
+
+        if waiting:
+            if self.ai_timer is not None:
+                self.ai_timer.cancel()
+            self.ai_timer = self.wheel.schedule(AI_DELAY, self.fire_ai)
+
+    def fire_ai(self):
+        self.actor.post(self.play_ai, self.ai_timer)
+
+    def play_ai(self, timer):
+        # Whatever it was scheduled for may have moved on since
+        if timer is not self.ai_timer or self.dead:
+            return
+        self.ai_timer = None
+
+        if self.current_state is State.waiting_for_answers:
+            for player in [player for player in self.pending_voters if is_ai(player)]:
+                self.on_input(Answer(player, vote(player)))
+        elif self.current_state is State.waiting_for_guess and is_ai(self.guessers.current):
+            player = self.guessers.current
+            self.on_input(guess(player, self.answers.get(player, 0), self.players, self.current_bet))
+
+    def give_hint(self):
+        """ The odds of the current bet and every one above it. Only
+            what everyone knows goes in, the yes rates: the guesser's
+            own answer would give it away to the rest of the chat.
+        """
+        if self.current_state is not State.waiting_for_guess:
+            self.announce_no_hint()
+            return
+
+        odds = ENGINE.odds(self.players)
+        bet = self.current_bet
+        self.announce_hint(bet, odds.doubt(bet), odds.fit(bet),
+                           [(n, odds.stands(n)) for n in range(max(bet + 1, 1), odds.players + 1)])
 
     def remove_nonvoters(self):
         prev_length = len(self.players)
-        for player in self.players:
-            if player not in self.answers:
-                self.remove_player(player, silent=False)
+        for player in list(self.pending_voters):
+            self.remove_player(player, silent=False)
 
         if len(self.players) < prev_length:
             self.get_angery()
 
+    def cancel(self, player, player_name):
+        """ Ends the game, if player owns it. """
+        if player == self.game_owner:
+            self.announce_cancel(player_name)
+            self.destroy()
+
     def destroy(self):
         self.cancel_timeout()
-        self.logger.removeHandler(self.handler)
+        if self.ai_timer is not None:
+            self.ai_timer.cancel()
+            self.ai_timer = None
         self.dead = True
+        if self.journal is not None:
+            self.journal.end_game(self)
+
+    def snapshot(self):
+        """ Everything needed to rebuild the game, as plain JSON data. """
+        return {
+            "game_id": self.game_id,
+            "seq": self.journal_seq,
+            "state": type(self.current_state).__name__,
+            "timeout": None if self.timeout_timer is None else self.timeout_timer.remaining(),
+            "players": list(self.players),
+            "player_names": list(self.player_names.items()),
+            "answers": list(self.answers.items()),
+            "pending_voters": list(self.pending_voters),
+            "questioners": list(self.questioners),
+            "guessers": list(self.guessers),
+            "previous_guesser": self.previous_guesser,
+            "current_question": self.current_question,
+            "current_bet": self.current_bet,
+            "final_guess": self.final_guess,
+            "final_player": self.final_player,
+            "game_owner": self.game_owner,
+            "angery_level": self.angery_level,
+            "locale": self.locale,
+        }
+
+    def restore(self, snapshot):
+        self.game_id = snapshot["game_id"]
+        self.journal_seq = snapshot["seq"]
+        self.current_state = STATES[snapshot["state"]]
+        self.players = Roster(snapshot["players"])
+        self.ai_players = sum(1 for player in self.players if is_ai(player))
+        self.player_names = dict(snapshot["player_names"])
+        self.answers = dict(snapshot["answers"])
+        self.yes_count = sum(self.answers.values())
+        # Journals written before votes were tallied have no pending voters
+        self.pending_voters = Roster(snapshot.get("pending_voters",
+                                                  (player for player in self.players if player not in self.answers)))
+        self.questioners = Roster(snapshot["questioners"])
+        self.guessers = Roster(snapshot["guessers"])
+        self.previous_guesser = snapshot["previous_guesser"]
+        self.current_question = snapshot["current_question"]
+        self.current_bet = snapshot["current_bet"]
+        self.final_guess = snapshot["final_guess"]
+        self.final_player = snapshot["final_player"]
+        self.game_owner = snapshot["game_owner"]
+        self.angery_level = snapshot["angery_level"]
+        self.locale = snapshot["locale"]
+        self.update_mode()
+        self.update_translation()
+
+        if snapshot["timeout"] is not None:
+            self.set_timeout(snapshot["timeout"])
+        if self.ai_players:
+            self.schedule_ai()
+
+    def replay(self, events):
+        """ Re-applies journaled events on top of a restored snapshot,
+            without journaling them again or announcing anything.
+        """
+        # Rounds replayed here were counted and learned the first time round
+        stats, self.stats = self.stats, None
+        rates, self.rates = self.rates, None
+        try:
+            for kind, data in events:
+                self.journal_seq += 1
+                if kind == "action":
+                    action_from_record(data).apply(self, self.current_state)
+                elif kind == "timeout":
+                    self.current_state.on_timeout(self)
+        finally:
+            self.stats = stats
+            self.rates = rates
+
+        self.announcement_buffer = []
+        self.current_poll = None
+        self.status = None
@@ -31,6 +31,9 @@ class State:
     def on_fit(self, context, player):
         pass
 
+    def on_add_ai(self, context, player):
+        pass
+
 
 class WaitingForPlayers(State):
     def run(self, context):
@@ -40,6 +43,11 @@ class WaitingForPlayers(State):
         context.add_player(player, name)
         context.set_timeout(30)
 
+    def on_add_ai(self, context, player):
+        if player in context.players:
+            context.add_ai_player()
+            context.set_timeout(30)
+
     def on_flee(self, context, player):
         context.remove_player(player)
         context.set_timeout(30)
@@ -58,21 +66,20 @@ class WaitingForQuestion(State):
         context.set_timeout(50)
 
     def on_flee(self, context, player):
-        was_questioner = player == context.questioners[0]
-        context.logger.debug("Was questioner: %r" % was_questioner)
+        was_questioner = player == context.questioners.current
+        context.logger.debug("Was questioner: %r", was_questioner)
         context.remove_player(player)
         if not context.check_game_over() and was_questioner:
             context.go_to(State.waiting_for_question)
 
     def on_question(self, context, player, question, initial_bet):
-        if player == context.questioners[0]:
+        if player == context.questioners.current:
             if initial_bet is not None and initial_bet > len(context.players):
                 context.announce_too_high_bet(len(context.players))
                 context.set_timeout(50)
                 return
 
             if question is not None and initial_bet is not None:
-                context.question = question
                 context.make_poll(context.player_names[player], question, initial_bet)
                 context.choose_next_guesser()
                 context.go_to(State.waiting_for_answers)
@@ -81,8 +88,8 @@ class WaitingForQuestion(State):
                 context.set_timeout(50)
 
     def on_timeout(self, context):
-        context.announce_timeout_kick(context.player_names[context.questioners[0]])
-        context.remove_player(context.questioners[0], silent=True)
+        context.announce_timeout_kick(context.player_names[context.questioners.current])
+        context.remove_player(context.questioners.current, silent=True)
         if not context.check_game_over():
             context.go_to(State.waiting_for_question)
 
@@ -98,9 +105,8 @@ class WaitingForAnswers(State):
     def on_answer(self, context, player, answer):
         context.add_answer(player, answer)
 
-        for player in context.players:
-            if player not in context.answers:
-                return
+        if context.pending_voters:
+            return
 
         context.announce_votes_received()
         context.go_to(State.waiting_for_guess)
@@ -120,14 +126,14 @@ class WaitingForGuess(State):
         context.set_timeout(50)
 
     def on_flee(self, context, player):
-        was_guesser = player == context.guessers[0]
-        context.logger.debug("Was guesser: %r" % was_guesser)
+        was_guesser = player == context.guessers.current
+        context.logger.debug("Was guesser: %r", was_guesser)
         context.remove_player(player)
         if not context.check_game_over() and was_guesser:
             context.go_to(State.waiting_for_guess)
 
     def on_bet(self, context, player, bet):
-        if player != context.guessers[0]:
+        if player != context.guessers.current:
             return
 
         if bet > len(context.players):
@@ -145,20 +151,20 @@ class WaitingForGuess(State):
         context.go_to(State.waiting_for_guess)
 
     def on_doubt(self, context, player):
-        if context.guessers[0] != player or context.previous_guesser is None:
+        if context.guessers.current != player or context.previous_guesser is None:
             return
         context.doubt(player)
         context.go_to(State.waiting_for_question)
 
     def on_fit(self, context, player):
-        if context.guessers[0] != player or context.previous_guesser is None:
+        if context.guessers.current != player or context.previous_guesser is None:
             return
         context.fit(player)
         context.go_to(State.waiting_for_question)
 
     def on_timeout(self, context):
-        context.announce_timeout_kick(context.player_names[context.guessers[0]])
-        context.remove_player(context.guessers[0], silent=True)
+        context.announce_timeout_kick(context.player_names[context.guessers.current])
+        context.remove_player(context.guessers.current, silent=True)
 
         if not context.check_game_over():
             context.go_to(State.waiting_for_guess)
@@ -168,3 +174,8 @@ State.waiting_for_players = WaitingForPlayers()
 State.waiting_for_question = WaitingForQuestion()
 State.waiting_for_guess = WaitingForGuess()
 State.waiting_for_answers = WaitingForAnswers()
+
+STATES = dict((type(state).__name__, state) for state in (State.waiting_for_players,
+                                                          State.waiting_for_question,
+                                                          State.waiting_for_guess,
+                                                          State.waiting_for_answers))
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from batchwriter import BatchWriter
+
+STATS_FILE = "stats.db"
+
+# Counters are written in batches, at most this many seconds after a round ends
+FLUSH_INTERVAL = 1.0
+# Players whose totals are kept in memory, least recently used first out
+MAX_PLAYERS = 10000
+# Other processes may be adding to the same players, so totals are re-read this often
+MAX_AGE = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    player_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    doubts INTEGER NOT NULL DEFAULT 0,
+    fits INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+UPSERT = """
+INSERT INTO players (player_id, name, wins, losses, doubts, fits) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (player_id) DO UPDATE SET
+    name = excluded.name,
+    wins = wins + excluded.wins,
+    losses = losses + excluded.losses,
+    doubts = doubts + excluded.doubts,
+    fits = fits + excluded.fits
+"""
+
+
+class PlayerStats:
+    __slots__ = ("name", "wins", "losses", "doubts", "fits", "loaded")
+
+    def __init__(self, name, wins=0, losses=0, doubts=0, fits=0, loaded=0.0):
+        self.name = name
+        self.wins = wins
+        self.losses = losses
+        self.doubts = doubts
+        self.fits = fits
+        self.loaded = loaded
+
+    def add(self, other):
+        self.name = other.name
+        self.wins += other.wins
+        self.losses += other.losses
+        self.doubts += other.doubts
+        self.fits += other.fits
+
+
+class Stats(BatchWriter):
+    """ Wins, losses, doubts and fits of every player, in SQLite.
+        Rounds only touch memory: each adds to the player's pending
+        counters, which make up the batch, and to their totals if they
+        are in the index. Lookups are answered from the index of
+        recently seen players; the others are read from the store.
+        Counters are added, never set, so processes can share a store.
+    """
+
+    contents = "players' stats"
+
+    def __init__(self, path=STATS_FILE, flush_interval=FLUSH_INTERVAL, max_players=MAX_PLAYERS, max_age=MAX_AGE):
+        self.max_players = max_players
+        self.max_age = max_age
+
+        # Totals of recently seen players, and of those being read, the
+        # read and the counters added to them since it was queued
+        self.index = OrderedDict()
+        self.reads = dict()
+        self.loading = dict()
+
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+        # Other processes may be writing to the same store, so wait longer for them
+        BatchWriter.__init__(self, path, SCHEMA, flush_interval, logging.getLogger("dudo.stats"), timeout=10.0)
+
+    def record_round(self, winner, winner_name, loser, loser_name, caller, doubted):
+        """ Counts a round won by winner and lost by loser, settled by
+            caller doubting or, if not doubted, calling a fit. Players
+            given as None are left out.
+        """
+        self._add(winner, winner_name, wins=1)
+        self._add(loser, loser_name, losses=1)
+        caller_name = winner_name if caller == winner else loser_name
+        if doubted:
+            self._add(caller, caller_name, doubts=1)
+        else:
+            self._add(caller, caller_name, fits=1)
+
+        self.schedule_flush()
+
+    def _add(self, player, name, wins=0, losses=0, doubts=0, fits=0):
+        if player is None:
+            return
+        change = PlayerStats(name, wins, losses, doubts, fits)
+
+        pending = self.pending.get(player)
+        if pending is None:
+            pending = self.pending[player] = PlayerStats(name)
+        pending.add(change)
+
+        added = self.loading.get(player)
+        if added is not None:
+            added.add(change)
+
+        totals = self.index.get(player)
+        if totals is not None:
+            totals.add(change)
+            self.index.move_to_end(player)
+
+    def new_batch(self):
+        return dict()
+
+    def write_batch(self, batch):
+        self.connection.executemany(UPSERT, [
+            (player, stats.name, stats.wins, stats.losses, stats.doubts, stats.fits)
+            for player, stats in batch.items()])
+        self.flushes += 1
+
+    async def lookup(self, player):
+        """ The player's totals, or None if they never finished a round. """
+        totals = self.index.get(player)
+        if totals is not None and time.monotonic() - totals.loaded < self.max_age:
+            self.hits += 1
+            self.index.move_to_end(player)
+            return totals
+
+        self.misses += 1
+        read = self.reads.get(player)
+        if read is None:
+            # Whatever is pending is written first, so that the read sees it
+            self.flush()
+            read = self.reads[player] = asyncio.wrap_future(self.read(self._read, player))
+            self.loading[player] = PlayerStats(None)
+            # Indexed once it's done, for every lookup of the player, even if they're all gone
+            read.add_done_callback(lambda done: self._loaded(player, done))
+        # One lookup cancelled, as when its handler closes, mustn't cancel the read for the others
+        await asyncio.shield(read)
+        return self.index.get(player)
+
+    def _loaded(self, player, read):
+        del self.reads[player]
+        added = self.loading.pop(player)
+        if not read.cancelled() and read.exception() is None:
+            self._index(player, read.result(), added)
+
+    def _index(self, player, row, added):
+        if row is None and added.name is None:
+            return
+
+        totals = PlayerStats(*row) if row is not None else PlayerStats(added.name)
+        if added.name is not None:
+            totals.add(added)
+        totals.loaded = time.monotonic()
+
+        self.index[player] = totals
+        self.index.move_to_end(player)
+        while len(self.index) > self.max_players:
+            self.index.popitem(last=False)
+
+    def _read(self, player):
+        return self.connection.execute("SELECT name, wins, losses, doubts, fits FROM players WHERE player_id = ?",
+                                       (player,)).fetchone()
+
+    def stats(self):
+        return {"players": len(self.index), "pending": len(self.pending), "hits": self.hits,
+                "misses": self.misses, "flushes": self.flushes}
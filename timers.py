@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import math
+
+TICK = 1.0
+SLOT_BITS = 6
+LEVELS = 4
+
+_wheel = None
+
+
+def get_wheel():
+    """ Returns the process-wide timing wheel, creating it on first use. """
+    global _wheel
+    if _wheel is None:
+        _wheel = TimingWheel()
+    return _wheel
+
+
+class Timer:
+    __slots__ = ("wheel", "expires", "callback", "args", "slot")
+
+    def __init__(self, wheel, expires, callback, args):
+        self.wheel = wheel
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+    def remaining(self):
+        """ Seconds left until the timer fires, rounded to the tick. """
+        wheel = self.wheel
+        return max(0.0, self.expires * wheel.tick - (wheel.loop_time() - wheel.origin)) / wheel.scale
+
+
+class TimingWheel:
+    """ Hierarchical timing wheel owning the deadlines of every game.
+        Arming and cancelling are O(1) set operations and a single
+        loop callback advances the wheel once per tick, only while
+        there are timers armed. Deadlines are rounded up to the tick.
+        A scale below 1 makes every delay shorter, for simulations.
+
+        Level n has 2 ** SLOT_BITS slots of 2 ** (SLOT_BITS * n) ticks
+        each; timers cascade down a level as their slot comes due.
+    """
+
+    def __init__(self, tick=TICK, slot_bits=SLOT_BITS, levels=LEVELS, scale=1.0):
+        self.logger = logging.getLogger("dudo.timers")
+        self.tick = tick
+        self.scale = scale
+        self.slot_bits = slot_bits
+        self.mask = (1 << slot_bits) - 1
+        self.levels = [[set() for _ in range(1 << slot_bits)] for _ in range(levels)]
+        self.max_ticks = (1 << (slot_bits * levels)) - 1
+
+        self.loop = None
+        self.origin = None
+        self.current = 0
+        self.handle = None
+        self.ticking = False
+        self.count = 0
+
+        self.armed = 0
+        self.cancelled = 0
+        self.fired = 0
+
+    def loop_time(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+            self.origin = self.loop.time()
+        return self.loop.time()
+
+    def schedule(self, delay, callback, *args):
+        """ Calls callback(*args) after delay seconds. Returns a Timer. """
+        elapsed = self.loop_time() - self.origin
+
+        if self.count == 0:
+            # Nothing is armed, so no slot is skipped by catching up
+            self.current = max(self.current, int(elapsed / self.tick))
+
+        ticks = min(max(int(math.ceil((elapsed + delay * self.scale) / self.tick)), self.current + 1),
+                    self.current + self.max_ticks)
+        timer = Timer(self, ticks, callback, args)
+        self._place(timer)
+        self.count += 1
+        self.armed += 1
+
+        if self.handle is None and not self.ticking:
+            self._schedule_tick()
+
+        return timer
+
+    def cancel(self, timer):
+        if timer.slot is None:
+            return
+        timer.slot.discard(timer)
+        timer.slot = None
+        self.count -= 1
+        self.cancelled += 1
+
+    def _place(self, timer):
+        delta = timer.expires - self.current
+        level = 0
+        while level < len(self.levels) - 1 and delta >> (self.slot_bits * (level + 1)):
+            level += 1
+
+        slot = self.levels[level][(timer.expires >> (self.slot_bits * level)) & self.mask]
+        slot.add(timer)
+        timer.slot = slot
+
+    def _schedule_tick(self):
+        self.handle = self.loop.call_at(self.origin + (self.current + 1) * self.tick, self._on_tick)
+
+    def _on_tick(self):
+        self.handle = None
+        target = int((self.loop.time() - self.origin) / self.tick)
+
+        self.ticking = True
+        try:
+            while self.current < target and self.count > 0:
+                self._advance()
+        finally:
+            self.ticking = False
+
+        if self.count > 0:
+            self._schedule_tick()
+
+    def _advance(self):
+        self.current += 1
+        current = self.current
+
+        # Whenever a level wraps around, the next level's slot comes due
+        level = 1
+        while level < len(self.levels) and not current & ((1 << (self.slot_bits * level)) - 1):
+            slot_index = (current >> (self.slot_bits * level)) & self.mask
+            timers = self.levels[level][slot_index]
+            self.levels[level][slot_index] = set()
+            for timer in timers:
+                self._place(timer)
+            level += 1
+
+        slot_index = current & self.mask
+        due = self.levels[0][slot_index]
+        if not due:
+            return
+        self.levels[0][slot_index] = set()
+
+        for timer in due:
+            timer.slot = None
+            self.count -= 1
+            self.fired += 1
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                self.logger.exception("Timer callback failed")
+
+    def stats(self):
+        return {"active": self.count, "armed": self.armed, "cancelled": self.cancelled, "fired": self.fired}
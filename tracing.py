@@ -0,0 +1,201 @@
+""" Opt-in tracing of the game's hot paths, switchable at runtime.
+
+    While tracing, the traced methods are replaced on their classes by
+    wrappers that time them; stopping puts the originals back, so when
+    off it costs nothing at all. Sampling is decided per outermost
+    call, and everything called under it is traced along with it. Each
+    game is its own track, by chat id.
+
+    Spans are exported as Chrome trace JSON, for chrome://tracing or
+    Perfetto, and as folded stacks of self time in microseconds, for
+    flamegraph.pl or speedscope.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+from collections import defaultdict, deque
+from time import perf_counter_ns
+
+# Spans kept, the oldest are dropped past this
+MAX_SPANS = 200000
+
+
+def traced_methods():
+    """ (class, method name) of every traced method. """
+    from announcer import Announcer
+    from insults import Insulter
+    from statemachine import DudoStateMachine
+    from states import State, STATES
+
+    yield DudoStateMachine, "on_input"
+    yield DudoStateMachine, "go_to"
+    yield Announcer, "force_announce"
+    yield Insulter, "get_insult"
+    for state_class in [State] + [type(state) for state in STATES.values()]:
+        for name, value in vars(state_class).items():
+            if callable(value) and not name.startswith("_"):
+                yield state_class, name
+
+
+def track_of(args):
+    """ The chat id of the game a call is about, if any. """
+    for arg in args[:2]:
+        chat_id = getattr(arg, "chat_id", None)
+        if chat_id is not None:
+            return chat_id
+    return 0
+
+
+class Tracer:
+    def __init__(self, max_spans=MAX_SPANS):
+        self.logger = logging.getLogger("dudo.tracing")
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.rng = random.Random()
+        self.originals = []
+        self.stop_handle = None
+
+        # Calls in progress: [label, start, time in children, path, track], or None if not sampled
+        self.stack = []
+        # (path, track, start, duration, self time), in nanoseconds
+        self.spans = deque(maxlen=max_spans)
+        self.origin = perf_counter_ns()
+
+    def start(self, sample_rate=1.0, duration=None):
+        """ Starts tracing a sample_rate share of calls, for duration
+            seconds if given. Spans of an earlier run are dropped.
+        """
+        self.sample_rate = sample_rate
+        self.spans.clear()
+        self.origin = perf_counter_ns()
+
+        if not self.enabled:
+            for owner, name in traced_methods():
+                function = vars(owner)[name]
+                self.originals.append((owner, name, function))
+                setattr(owner, name, self.wrap(function, "%s.%s" % (owner.__name__, name)))
+            self.enabled = True
+
+        if self.stop_handle is not None:
+            self.stop_handle.cancel()
+            self.stop_handle = None
+        if duration is not None:
+            self.stop_handle = asyncio.get_event_loop().call_later(duration, self.stop)
+        self.logger.info("Tracing %.0f%% of calls%s", sample_rate * 100,
+                         "" if duration is None else " for %g seconds" % duration)
+
+    def stop(self):
+        """ Puts the original methods back. The spans are kept. """
+        if self.stop_handle is not None:
+            self.stop_handle.cancel()
+            self.stop_handle = None
+        if not self.enabled:
+            return
+        for owner, name, function in reversed(self.originals):
+            setattr(owner, name, function)
+        self.originals = []
+        self.stack = []
+        self.enabled = False
+        self.logger.info("Tracing stopped with %d spans", len(self.spans))
+
+    def wrap(self, function, label):
+        tracer = self
+
+        # Wrappers already looked up, as the bound methods in game mailboxes
+        # are, still get called after stop(); they record nothing then
+        if asyncio.iscoroutinefunction(function):
+            # Others run while it waits, so it can't be on the stack; it's always outermost
+            @functools.wraps(function)
+            async def traced(*args, **kwargs):
+                if not tracer.enabled or tracer.stack or tracer.rng.random() >= tracer.sample_rate:
+                    return await function(*args, **kwargs)
+                start = perf_counter_ns()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    if tracer.enabled:
+                        duration = perf_counter_ns() - start
+                        tracer.spans.append((label, track_of(args), start, duration, duration))
+        else:
+            @functools.wraps(function)
+            def traced(*args, **kwargs):
+                if not tracer.enabled:
+                    return function(*args, **kwargs)
+                tracer.enter(label, args)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    tracer.exit()
+
+        return traced
+
+    def enter(self, label, args):
+        stack = self.stack
+        if stack:
+            parent = stack[-1]
+            if parent is None:
+                stack.append(None)
+            else:
+                stack.append([label, perf_counter_ns(), 0, parent[3] + ";" + label, parent[4]])
+        elif self.rng.random() < self.sample_rate:
+            stack.append([label, perf_counter_ns(), 0, label, track_of(args)])
+        else:
+            stack.append(None)
+
+    def exit(self):
+        frame = self.stack.pop()
+        if frame is None:
+            return
+        _, start, children, path, track = frame
+        duration = perf_counter_ns() - start
+        if self.stack:
+            self.stack[-1][2] += duration
+        self.spans.append((path, track, start, duration, duration - children))
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        events = [{"name": path.rpartition(";")[2], "cat": "dudo", "ph": "X", "pid": pid, "tid": track,
+                   "ts": (start - self.origin) / 1000.0, "dur": duration / 1000.0}
+                  for path, track, start, duration, _ in self.spans]
+        return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
+
+    def folded(self):
+        self_times = defaultdict(int)
+        for path, _, _, _, self_time in self.spans:
+            self_times[path] += self_time
+        return "".join("%s %d\n" % (path, self_time // 1000) for path, self_time in sorted(self_times.items()))
+
+    def write(self, path):
+        """ Writes the Chrome trace to path, and the folded stacks next to it. """
+        with open(path, "w") as trace_file:
+            trace_file.write(self.chrome_trace())
+        with open(os.path.splitext(path)[0] + ".folded", "w") as folded_file:
+            folded_file.write(self.folded())
+
+    def routes(self):
+        """ HTTP routes to control tracing and fetch its output:
+            start?sample=R&seconds=S, stop, trace.json and folded.
+        """
+        def start(query):
+            sample_rate = float(query.get("sample", 1.0))
+            if not 0 < sample_rate <= 1:
+                raise ValueError("sample must be in (0, 1]")
+            self.start(sample_rate, float(query["seconds"]) if "seconds" in query else None)
+            return "200 OK", "text/plain", "tracing\n"
+
+        def stop(query):
+            self.stop()
+            return "200 OK", "text/plain", "stopped with %d spans\n" % len(self.spans)
+
+        return {
+            "/tracing/start": start,
+            "/tracing/stop": stop,
+            "/tracing/trace.json": lambda query: ("200 OK", "application/json", self.chrome_trace()),
+            "/tracing/folded": lambda query: ("200 OK", "text/plain", self.folded()),
+        }
+
+
+TRACER = Tracer()
@@ -0,0 +1,23 @@
+""" Reading Telegram updates, for every way they come in: long polling,
+    the webhook and the sharding front. Kept free of dependencies, so
+    that importing it costs the webhook nothing at startup.
+"""
+MESSAGE_KEYS = ("message", "edited_message", "callback_query")
+
+
+def message_of(update):
+    """ The message in an update, as DelegatorBot.handle expects it. """
+    for key in MESSAGE_KEYS:
+        if key in update:
+            return update[key]
+    return None
+
+
+def chat_of(update):
+    message = message_of(update)
+    if message is None:
+        return None
+    if "chat" not in message:
+        # Callback queries carry the chat in the message with the keyboard
+        message = message.get("message", {})
+    return message.get("chat", {}).get("id")
@@ -0,0 +1,112 @@
+""" Webhook ingestion: Telegram POSTs every update to us as it happens,
+    instead of us long-polling for them. Each request must carry the
+    secret token the webhook was registered with. Updates are handed
+    straight to the delegator, or to the sharding front, in the order
+    they arrive; at most max_concurrency requests are read at once.
+"""
+import asyncio
+import hmac
+import inspect
+import json
+import logging
+import secrets
+
+from aiohttp import web
+
+from updates import message_of
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WEBHOOK_PATH = "/webhook"
+MAX_CONCURRENCY = 100
+ALLOWED_UPDATES = ["message", "edited_message", "callback_query"]
+
+
+def new_secret():
+    # Telegram allows 1-256 characters out of A-Z, a-z, 0-9, _ and -
+    return secrets.token_urlsafe(32)
+
+
+def bot_handler(bot):
+    """ Feeds updates to a DelegatorBot, as MessageLoop would. """
+    def handle(update):
+        message = message_of(update)
+        if message is not None:
+            bot.handle(message)
+    return handle
+
+
+async def register(bot, url, secret, max_connections=MAX_CONCURRENCY):
+    """ Points Telegram at url. telepot's setWebhook predates secret
+        tokens, so this goes through its raw API request, which sends
+        parameters as they are: lists must be JSON already.
+    """
+    return await bot._api_request("setWebhook", {
+        "url": url,
+        "secret_token": secret,
+        "max_connections": max_connections,
+        "allowed_updates": json.dumps(ALLOWED_UPDATES),
+    })
+
+
+class WebhookServer:
+    """ handle(update) is called for every authentic update. It may
+        return an awaitable, which is waited on before answering.
+    """
+
+    def __init__(self, handle, secret, path=WEBHOOK_PATH, max_concurrency=MAX_CONCURRENCY):
+        self.logger = logging.getLogger("dudo.webhook")
+        self.handle = handle
+        self.secret = secret.encode()
+        self.path = path
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.runner = None
+
+        self.accepted = 0
+        self.rejected = 0
+        self.malformed = 0
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.on_update)
+        return app
+
+    async def on_update(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+
+        async with self.semaphore:
+            try:
+                update = await request.json()
+            except ValueError:
+                update = None
+            if not isinstance(update, dict):
+                self.malformed += 1
+                return web.Response(status=400)
+
+            try:
+                result = self.handle(update)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                # Telegram would only send it again
+                self.logger.exception("Could not handle update %s", update.get("update_id"))
+
+        self.accepted += 1
+        return web.Response()
+
+    async def start(self, host, port):
+        self.runner = web.AppRunner(self.make_app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.logger.info("Listening for updates on %s:%s%s", host, port, self.path)
+        return site
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def stats(self):
+        return {"accepted": self.accepted, "rejected": self.rejected, "malformed": self.malformed}